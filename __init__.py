@@ -73,6 +73,14 @@ class RenderSettingsScene(bpy.types.PropertyGroup):
         name="auto_redraw",
         description="continously request external to renderer, usefull if update on external side, like playing animation but require more resource",
         default=False)
+    quantize_vertices = bpy.props.BoolProperty(
+        name="quantize_vertices",
+        description="send vertex arrays as quantized integers (smaller), the external renderer should support it (xbuf_quantization_1) else keep floats",
+        default=False)
+    mesh_patches = bpy.props.BoolProperty(
+        name="mesh_patches",
+        description="send only the changed vertices of edited meshes (not quantized), the external renderer should support it (xbuf_patch_1) else send whole meshes",
+        default=False)
 
     def __init__(self):
         pass
@@ -88,6 +96,52 @@ class xbufSettingsScene(bpy.types.PropertyGroup):
         description="Full path to directory where the assets are saved",
         default=os.path.abspath(os.path.expanduser("~/assets")),
         maxlen=1024, subtype="DIR_PATH")
+    skin_fixed_stride = bpy.props.BoolProperty(
+        name="fixed stride skin",
+        description="export only the strongest bone influences of every vertex, with the same count for every vertex (ready for gpu)",
+        default=False)
+    skin_max_influences = bpy.props.IntProperty(
+        name="max bone influences",
+        description="number of bone influences per vertex of fixed stride skin",
+        default=4, min=1, max=16)
+    lod_count = bpy.props.IntProperty(
+        name="levels of detail",
+        description="number of simplified levels of detail exported with every mesh",
+        default=0, min=0, max=8)
+    lod_ratio = bpy.props.FloatProperty(
+        name="lod ratio",
+        description="ratio of triangles kept from a level of detail to the next one",
+        default=0.5, min=0.05, max=0.95)
+    encode_workers = bpy.props.IntProperty(
+        name="encoding processes",
+        description="number of processes (forked from blender) encoding the meshes (0: encode in the blender process)",
+        default=0, min=0, max=64)
+    texture_workers = bpy.props.IntProperty(
+        name="texture threads",
+        description="number of textures copied concurrently into the assets folder (0: copy during the export)",
+        default=4, min=0, max=64)
+    texture_strategy = bpy.props.EnumProperty(
+        name="texture files",
+        description="how texture files are put into the assets folder (fallback to copy when not supported)",
+        items=[
+            ('COPY', "copy", "copy the content of the file"),
+            ('HARDLINK', "hard link", "hard link to the file (same filesystem only)"),
+            ('SYMLINK', "symbolic link", "symbolic link to the file"),
+            ('REFLINK', "reflink", "copy on write clone of the file (linux, btrfs or xfs)"),
+        ],
+        default='COPY')
+    max_vertices = bpy.props.IntProperty(
+        name="max vertices per mesh",
+        description="split meshes into chunks with at most this number of vertices, eg 65535 for 16 bits indices (0xffff is kept for the restart of strips), 0: no split, else at least 3",
+        default=0, min=0)
+    vertex_cache_size = bpy.props.IntProperty(
+        name="vertex cache size",
+        description="reorder triangles and vertices of meshes for a post-transform vertex cache of this size, slower export (0: keep the order of blender)",
+        default=0, min=0, max=64)
+    triangle_strips = bpy.props.BoolProperty(
+        name="triangle strips",
+        description="export meshes as triangle strips (with primitive restart index 0xffffffff) when they are smaller than triangles",
+        default=False)
 
     def __init__(self):
         pass
@@ -119,8 +173,24 @@ class ExternalRenderPanel(bpy.types.Panel):
         row.prop(render, "port")
         row = layout.row()
         row.prop(render, "auto_redraw")
+        row.prop(render, "quantize_vertices")
+        row.prop(render, "mesh_patches")
         col = layout.column()
         col.prop(xbuf, "assets_path")
+        row = layout.row()
+        row.prop(xbuf, "skin_fixed_stride")
+        row.prop(xbuf, "skin_max_influences")
+        row = layout.row()
+        row.prop(xbuf, "lod_count")
+        row.prop(xbuf, "lod_ratio")
+        row = layout.row()
+        row.prop(xbuf, "encode_workers")
+        row.prop(xbuf, "max_vertices")
+        row.prop(xbuf, "vertex_cache_size")
+        row = layout.row()
+        row.prop(xbuf, "triangle_strips")
+        row.prop(xbuf, "texture_workers")
+        row.prop(xbuf, "texture_strategy")
         # layout.label(text="Hello World")
 
 
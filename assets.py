@@ -0,0 +1,315 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# write of the assets (textures,...) into the assets folder, without bpy
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+
+# file (into the assets folder) recording the files written by the exporter
+MANIFEST_NAME = ".xbuf_manifest.json"
+CHUNK_SIZE = 1024 * 1024
+
+# strategies to materialize a source file into the assets folder (see materialize),
+# every strategy but COPY falls back to COPY when it's not supported (eg source on another filesystem)
+COPY = 'COPY'
+HARDLINK = 'HARDLINK'
+SYMLINK = 'SYMLINK'
+# copy on write clone of the file (btrfs, xfs,...), linux only
+REFLINK = 'REFLINK'
+# ioctl request to clone a file (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def stat_key(path):
+    """return [size, mtime in ns] of the file at path, or None if there is no file"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_atomic(path, write):
+    """call write(file) on a temporary file, then rename it to path (readers never see a partial file)"""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=dirname, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def copy_with_sha1(src_path, dst):
+    """copy the content of the file src_path into the file dst, return its sha1"""
+    h = hashlib.sha1()
+    with open(src_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+            dst.write(chunk)
+    return h.hexdigest()
+
+
+def link_atomic(path, link):
+    """call link(temporary path), then rename it to path"""
+    tmp_path = "%s.tmp_%d_%d" % (path, os.getpid(), threading.get_ident())
+    link(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def reflink(src_path, dst):
+    """clone the content of the file src_path into the (empty) file dst"""
+    import fcntl
+    with open(src_path, 'rb') as f:
+        fcntl.ioctl(dst.fileno(), FICLONE, f.fileno())
+
+
+def materialize(src_path, dst_path, strategy):
+    """
+    make dst_path with the content of src_path with strategy (or COPY if strategy fails),
+    return (strategy used, sha1 of the content or None if not read)
+    """
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    try:
+        if strategy == HARDLINK:
+            link_atomic(dst_path, lambda tmp_path: os.link(src_path, tmp_path))
+            return (strategy, None)
+        if strategy == SYMLINK:
+            link_atomic(dst_path, lambda tmp_path: os.symlink(os.path.abspath(src_path), tmp_path))
+            return (strategy, None)
+        if strategy == REFLINK:
+            write_atomic(dst_path, lambda f: reflink(src_path, f))
+            return (strategy, None)
+    except (OSError, ImportError, NotImplementedError):
+        pass
+    sha1s = []
+    write_atomic(dst_path, lambda f: sha1s.append(copy_with_sha1(src_path, f)))
+    return (COPY, sha1s[0])
+
+
+class AssetsManifest:
+    """
+    manifest of the files written into the assets folder (saved into it as MANIFEST_NAME),
+    {rpath: {"stat": [size, mtime] of the written file, "sha1": of its content, "source": [size, mtime] of the source file}},
+    a file is written only if it was changed since written, or if its new content differs (size, mtime
+    of the source unchanged or same sha1).
+    Files can be written from several threads (see AssetsWriter), but not the same rpath concurrently.
+    """
+
+    def __init__(self, assets_path):
+        self.assets_path = assets_path
+        self.path = os.path.join(assets_path, MANIFEST_NAME)
+        self._entries = None
+        self._modified = False
+        self._lock = threading.RLock()
+
+    def entries(self):
+        """return the entries, loaded on first call"""
+        with self._lock:
+            if self._entries is None:
+                try:
+                    with open(self.path, 'r') as f:
+                        self._entries = json.load(f)
+                except (OSError, ValueError):
+                    self._entries = {}
+            return self._entries
+
+    def _unchanged(self, rpath):
+        """return the entry of rpath if the file was not changed since written, else None"""
+        entry = self.entries().get(rpath)
+        if entry is not None and entry["stat"] == stat_key(os.path.join(self.assets_path, rpath)):
+            return entry
+        return None
+
+    def _record(self, rpath, sha1, source):
+        with self._lock:
+            self.entries()[rpath] = {"stat": stat_key(os.path.join(self.assets_path, rpath)), "sha1": sha1, "source": source}
+            self._modified = True
+
+    def copy_file(self, src_path, rpath, strategy=COPY):
+        """
+        materialize the file src_path as rpath (relative to the assets folder) with strategy if needed,
+        return True if materialized, raise FileNotFoundError if there is no file src_path
+        """
+        dst_path = os.path.join(self.assets_path, rpath)
+        source = stat_key(src_path)
+        if source is None:
+            raise FileNotFoundError(src_path)
+        entry = self._unchanged(rpath)
+        if entry is not None and entry["source"] == source:
+            return False
+        if os.path.exists(dst_path) and os.path.samefile(src_path, dst_path):
+            # already linked (or the source is into the assets folder)
+            self._record(rpath, entry["sha1"] if entry is not None else None, source)
+            return False
+        if strategy == COPY and (entry is not None or (stat_key(dst_path) or [None])[0] == source[0]):
+            # source touched, or destination written before the manifest: compare the contents
+            # (links are cheaper than reading the files)
+            sha1 = file_sha1(src_path)
+            if sha1 == (entry["sha1"] if entry is not None else file_sha1(dst_path)):
+                self._record(rpath, sha1, source)
+                return False
+        (_, sha1) = materialize(src_path, dst_path, strategy)
+        self._record(rpath, sha1, source)
+        return True
+
+    def write_bytes(self, content, rpath):
+        """write content to rpath (relative to the assets folder) if needed, return True if written"""
+        sha1 = hashlib.sha1(content).hexdigest()
+        entry = self._unchanged(rpath)
+        if entry is not None and entry["sha1"] == sha1:
+            return False
+        write_atomic(os.path.join(self.assets_path, rpath), lambda f: f.write(content))
+        self._record(rpath, sha1, None)
+        return True
+
+    def save(self):
+        """write the manifest if it was modified"""
+        with self._lock:
+            if self._modified:
+                content = json.dumps(self._entries, indent=1, sort_keys=True).encode("utf-8")
+                write_atomic(self.path, lambda f: f.write(content))
+                self._modified = False
+
+
+class AssetsWriter:
+    """
+    write the assets (with the methods of AssetsManifest) in a bounded pool of threads (or in the current
+    thread if workers < 1), so the export doesn't wait for the I/O, the manifest is saved once the writes
+    of an export are done (see end_batch) and by close. The failed writes are kept to be submitted again
+    (see retry_failed).
+    """
+
+    def __init__(self, manifest, workers, info, warning, strategy=COPY):
+        self.manifest = manifest
+        self.workers = workers
+        # materialization of the source files (see materialize)
+        self.strategy = strategy
+        self.info = info
+        self.warning = warning
+        self._pool = None
+        self._lock = threading.Lock()
+        # a lock per rpath, so the same file is not written by several threads at once
+        self._rpath_locks = {}
+        self._done = 0
+        self._total = 0
+        self._save_requested = False
+        # [(write, src, rpath)] of the failed writes (protected by _lock)
+        self._failed = []
+        # number of writes submitted by rpath, only the last one submitted is written
+        self._submitted = {}
+
+    def copy_file(self, src_path, rpath):
+        """materialize src_path as rpath"""
+        self._submit(self._copy_file, src_path, rpath)
+
+    def _copy_file(self, src_path, rpath):
+        return self.manifest.copy_file(src_path, rpath, self.strategy)
+
+    def write_bytes(self, content, rpath):
+        """write content as rpath"""
+        self._submit(self.manifest.write_bytes, content, rpath)
+
+    def retry_failed(self):
+        """submit again the writes failed since the last call, return their number"""
+        with self._lock:
+            (failed, self._failed) = (self._failed, [])
+        for write, src, rpath in failed:
+            self._submit(write, src, rpath)
+        return len(failed)
+
+    def _submit(self, write, src, rpath):
+        with self._lock:
+            self._total += 1
+            rpath_lock = self._rpath_locks.setdefault(rpath, threading.Lock())
+            submitted = self._submitted[rpath] = self._submitted.get(rpath, 0) + 1
+            if self._pool is None and self.workers > 0:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        def task():
+            written = None
+            with rpath_lock:
+                with self._lock:
+                    # else a write of rpath submitted after this one (eg a retry and a new version) will write it
+                    last = self._submitted[rpath] == submitted
+                if last:
+                    try:
+                        written = write(src, rpath)
+                    except OSError as exc:
+                        self.warning("failed to write %r: %s" % (rpath, exc))
+                        with self._lock:
+                            self._failed.append((write, src, rpath))
+            self._end(rpath, written)
+        if self._pool is None:
+            task()
+        else:
+            self._pool.submit(task)
+
+    def _end(self, rpath, written):
+        save = False
+        with self._lock:
+            self._done += 1
+            (done, total) = (self._done, self._total)
+            if done == total:
+                self._done = 0
+                self._total = 0
+                save = self._save_requested
+                self._save_requested = False
+        if written is not None:
+            self.info("%s %r (%d/%d)" % ("written" if written else "up to date", rpath, done, total))
+        if save:
+            self.manifest.save()
+
+    def end_batch(self):
+        """save the manifest now if every submitted write is done, else when the last one is done"""
+        with self._lock:
+            save = self._done == self._total
+            self._save_requested = not save
+        if save:
+            self.manifest.save()
+
+    def progress(self):
+        """return (done, total) of the writes submitted since the last time every write was done"""
+        with self._lock:
+            return (self._done, self._total)
+
+    def close(self):
+        """wait the end of the writes, save the manifest"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self.manifest.save()
@@ -0,0 +1,515 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# encoding of the mesh arrays (extracted by xbuf_export) into xbuf messages,
+# without bpy, so it can run in worker processes
+
+import os
+import hashlib
+import multiprocessing
+import concurrent.futures
+import numpy
+import xbuf
+import xbuf.datas_pb2
+
+from . import mesh_utils  # pylint: disable=W0406
+
+# encoding of the quantized vertex arrays, the receiver should support it (see ExportCfg.quantize_vertices
+# and export_quantized_vertex_arrays for the layout)
+QUANTIZATION_VERSION = 1
+QUANTIZATION = "xbuf_quantization_%d" % QUANTIZATION_VERSION
+# encoding of the vertex patches, the receiver should support it (see ExportCfg.mesh_patches)
+PATCH = "xbuf_patch_1"
+# a mesh is sent again (instead of a patch) when more than this ratio of its vertex arrays changed
+PATCH_MAX_RATIO = 0.25
+# number of vertices per digest kept by MeshPatcher (a changed vertex sends the vertices of its block)
+PATCH_BLOCK = 16
+
+
+class MeshPayload:
+    """everything needed to encode a xbuf.Mesh (picklable)"""
+
+    def __init__(self, id, name, lod, arrays, skin, quantize, vertex_cache_size=0, triangle_strips=False, morphs=(), lod_triangles=0):
+        self.id = id
+        self.name = name
+        self.lod = lod
+        # mesh_utils.MeshArrays
+        self.arrays = arrays
+        # None or (boneCount, boneIndex, boneWeight)
+        self.skin = skin
+        self.quantize = quantize
+        # reorder triangles and vertices for a post-transform vertex cache of this size (0: keep the order)
+        self.vertex_cache_size = vertex_cache_size
+        # export triangle strips (with mesh_utils.STRIP_RESTART between strips) if they are smaller than the triangles
+        self.triangle_strips = triangle_strips
+        # [(name, moved, deltas)] moved are the (sorted) arrays.vertex moved by the morph, deltas their moves
+        self.morphs = morphs
+        # decimate arrays to (about) this number of triangles before encoding (0: arrays are the level of detail),
+        # so the levels of detail are simplified by the encoder (in its workers)
+        self.lod_triangles = lod_triangles
+
+
+def encode_mesh(payload):
+    """
+    return ([(field of xbuf.Data, encoded message)], [info messages],
+    indices of the vertices of payload.arrays in the order of the encoded vertices or None if same order,
+    and None for a decimated level of detail: its vertices are not the ones of payload.arrays)
+    """
+    infos = []
+    arrays = payload.arrays
+    skin = payload.skin
+    kept = None
+    if payload.lod_triangles > 0:
+        # decimation collapses edges between shared vertices
+        welded = mesh_utils.weld(arrays)
+        arrays = mesh_utils.decimate(welded, dict(welded.vertex_arrays)[xbuf.datas_pb2.VertexArray.position], payload.lod_triangles)
+        if skin is not None:
+            # the skin of a vertex is the one of its blender vertex
+            skin = select_skin(skin, first_of_vertices(payload.arrays.vertex, arrays.vertex))
+        infos.append("lod %d of %r: %d -> %d triangles" % (payload.lod, payload.name, len(payload.arrays.triangles), len(arrays.triangles)))
+    if payload.vertex_cache_size > 0:
+        before = mesh_utils.acmr(arrays.triangles, payload.vertex_cache_size)
+        # the acmr of the new order comes from tipsify
+        (arrays, kept, acmr) = mesh_utils.optimize_vertex_cache(arrays, payload.vertex_cache_size)
+        if skin is not None:
+            skin = select_skin(skin, kept)
+        infos.append("vertex cache (%d) of %r: acmr %.3f -> %.3f" % (payload.vertex_cache_size, payload.name, before, acmr))
+    dst = xbuf.datas_pb2.Mesh()
+    dst.id = payload.id
+    dst.name = payload.name
+    dst.lod = payload.lod
+    strips = None
+    if payload.triangle_strips:
+        strips = mesh_utils.stripify(arrays.triangles)
+        list_size = mesh_utils.varint_size(arrays.triangles.ravel().astype(numpy.uint32))
+        strips_size = mesh_utils.varint_size(strips)
+        infos.append("triangle strips of %r: %d -> %d bytes (%s)" % (payload.name, list_size, strips_size, "used" if strips_size < list_size else "not used"))
+        if strips_size >= list_size:
+            strips = None
+    if strips is None:
+        dst.primitive = xbuf.datas_pb2.Mesh.triangles
+        export_index(dst, arrays.triangles)
+    else:
+        dst.primitive = xbuf.datas_pb2.Mesh.triangle_strip
+        export_strips_index(dst, strips)
+    encoded = []
+    if payload.quantize:
+        params = xbuf.datas_pb2.CustomParamList()
+        export_quantized_vertex_arrays(dst, arrays.vertex_arrays, params, infos)
+        encoded.append(("custom_params", params.SerializeToString()))
+    else:
+        for attrib, values in arrays.vertex_arrays:
+            export_vertex_array(dst, attrib, values)
+    if len(payload.morphs) > 0:
+        params = xbuf.datas_pb2.CustomParamList()
+        export_morphs(dst, arrays.vertex, payload.morphs, params)
+        encoded.append(("custom_params", params.SerializeToString()))
+    if skin is not None:
+        export_skin_arrays(dst, *skin)
+    positions = dict(arrays.vertex_arrays).get(xbuf.datas_pb2.VertexArray.position)
+    if positions is not None:
+        params = xbuf.datas_pb2.CustomParamList()
+        export_bounds(params, bounds_id(dst.id), mesh_utils.bounds(positions))
+        encoded.append(("custom_params", params.SerializeToString()))
+    encoded.insert(0, ("meshes", dst.SerializeToString()))
+    return (encoded, infos, kept if payload.lod_triangles == 0 else None)
+
+
+def select_skin(skin, kept):
+    """return the skin arrays of the kept vertices"""
+    (boneCount, boneIndex, boneWeight) = skin
+    if boneIndex.ndim == 2:
+        # fixed stride
+        return (boneCount[kept], boneIndex[kept], boneWeight[kept])
+    start = numpy.cumsum(boneCount) - boneCount
+    selected = mesh_utils.gather_ranges(start[kept], boneCount[kept])
+    return (boneCount[kept], boneIndex[selected], boneWeight[selected])
+
+
+def first_of_vertices(vertex, selected):
+    """return the index of the first item of vertex equal to every item of selected (all in vertex)"""
+    order = numpy.argsort(vertex, kind='mergesort')
+    return order[numpy.searchsorted(vertex[order], selected)]
+
+
+def export_vertex_array(dst_mesh, attrib, values):
+    dst = dst_mesh.vertexArrays.add()
+    dst.attrib = attrib
+    dst.floats.step = values.shape[1]
+    dst.floats.values.extend(values.ravel().tolist())
+
+
+def export_index(dst_mesh, triangles):
+    dst = dst_mesh.indexArrays.add()
+    dst.ints.step = 3
+    dst.ints.values.extend(triangles.ravel().tolist())
+
+
+def export_strips_index(dst_mesh, strips):
+    dst = dst_mesh.indexArrays.add()
+    dst.ints.step = 1
+    dst.ints.values.extend(strips.tolist())
+
+
+def export_skin_arrays(dst_mesh, boneCount, boneIndex, boneWeight):
+    dst_skin = dst_mesh.skin
+    dst_skin.boneCount.extend(boneCount.tolist())
+    dst_skin.boneIndex.extend(boneIndex.ravel().tolist())
+    dst_skin.boneWeight.extend(boneWeight.ravel().tolist())
+
+
+def export_quantized_vertex_arrays(dst_mesh, vertex_arrays, params, infos):
+    """
+    export vertex arrays as quantized integers into dst_mesh.indexArrays (after the index of triangles),
+    described by the CustomParamList params (to relate to dst_mesh).
+    A receiver that doesn't know this encoding would read the quantized arrays as indices, so params starts with
+    the markers a receiver should check (and reject the mesh if it doesn't support them):
+    - "encoding": QUANTIZATION
+    - "version": QUANTIZATION_VERSION
+    - "required": True (the mesh can't be read without params)
+    - "index_arrays": the number of arrays of dst_mesh.indexArrays that are indices (the first ones)
+    then for every quantized attribute:
+    - "<attrib>": the index of its array into dst_mesh.indexArrays
+    - "<attrib>.encoding": "unorm16" (see mesh_utils.quantize_unorm) or "smallest_three10" (see
+      mesh_utils.quantize_quat_smallest_three)
+    - "<attrib>.offset", "<attrib>.scale": vec2/3/4 (only for "unorm16")
+    vertex arrays that can't be quantized are exported as floats (into dst_mesh.vertexArrays).
+    """
+    params.id = quantization_id(dst_mesh.id)
+    param = params.params.add()
+    param.name = "encoding"
+    param.vstring = QUANTIZATION
+    param = params.params.add()
+    param.name = "version"
+    param.vint = QUANTIZATION_VERSION
+    param = params.params.add()
+    param.name = "required"
+    param.vbool = True
+    param = params.params.add()
+    param.name = "index_arrays"
+    param.vint = len(dst_mesh.indexArrays)
+    floats_size = 0
+    ints_size = 0
+    for attrib, values in vertex_arrays:
+        name = xbuf.datas_pb2.VertexArray.Attrib.Name(attrib)
+        if attrib == xbuf.datas_pb2.VertexArray.tbn_to_model_quat:
+            encoding = "smallest_three10"
+            ints = mesh_utils.quantize_quat_smallest_three(values, 10)
+            step = 1
+        elif 2 <= values.shape[1] <= 4:
+            encoding = "unorm16"
+            (offset, scale, ints) = mesh_utils.quantize_unorm(values, 16)
+            step = values.shape[1]
+            cnv_vec_n(offset, params.params.add(), name + ".offset")
+            cnv_vec_n(scale, params.params.add(), name + ".scale")
+        else:
+            export_vertex_array(dst_mesh, attrib, values)
+            continue
+        param = params.params.add()
+        param.name = name
+        param.vint = len(dst_mesh.indexArrays)
+        param = params.params.add()
+        param.name = name + ".encoding"
+        param.vstring = encoding
+        dst = dst_mesh.indexArrays.add()
+        dst.ints.step = step
+        dst.ints.values.extend(ints.ravel().tolist())
+        floats_size += values.size * 4
+        ints_size += mesh_utils.varint_size(ints.ravel())
+    infos.append("quantize vertex arrays of %r: %d -> %d bytes (%d saved)" % (dst_mesh.name, floats_size, ints_size, floats_size - ints_size))
+
+
+def export_morphs(dst_mesh, vertex, morphs, params):
+    """
+    export morphs as sparse vertex arrays (attrib position, morph = 1 + index into morphs) with the moves
+    (dx, dy, dz) of the vertices moved by the morph, and the indices of these vertices (relative to the vertex arrays)
+    into an array of dst_mesh.indexArrays (ints, step 1).
+    The CustomParamList params (to relate to dst_mesh) has for every morph the params "<name of the morph>": morph
+    and "morph<morph>.indices": the index of the array of its indices into dst_mesh.indexArrays.
+    """
+    indices = []
+    for i, (name, moved, deltas) in enumerate(morphs):
+        if len(moved) > 0:
+            pos = numpy.minimum(numpy.searchsorted(moved, vertex), len(moved) - 1)
+            selected = numpy.flatnonzero(moved[pos] == vertex)
+            values = deltas[pos[selected]]
+        else:
+            (selected, values) = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, 3), dtype=numpy.float32))
+        dst = dst_mesh.vertexArrays.add()
+        dst.attrib = xbuf.datas_pb2.VertexArray.position
+        dst.morph = i + 1
+        dst.floats.step = 3
+        dst.floats.values.extend(values.ravel().tolist())
+        indices.append(len(dst_mesh.indexArrays))
+        dst_index = dst_mesh.indexArrays.add()
+        dst_index.ints.step = 1
+        dst_index.ints.values.extend(selected.tolist())
+    export_morphs_names(params, dst_mesh.id, morphs, indices)
+
+
+def export_morphs_names(params, mesh_id, morphs, indices):
+    """fill the CustomParamList params of the morphs of the mesh (see export_morphs)"""
+    params.id = morphs_id(mesh_id)
+    for i, (name, _, _) in enumerate(morphs):
+        param = params.params.add()
+        param.name = name
+        param.vint = i + 1
+        param = params.params.add()
+        param.name = "morph%d.indices" % (i + 1)
+        param.vint = indices[i]
+
+
+def export_bounds(params, id, bounds):
+    """
+    fill the CustomParamList params with the bounds (see mesh_utils.bounds) in local space:
+    "aabb.min", "aabb.max": vec3, "sphere.center": vec3, "sphere.radius": float
+    """
+    params.id = id
+    (aabb_min, aabb_max, center, radius) = bounds
+    cnv_vec_n(aabb_min, params.params.add(), "aabb.min")
+    cnv_vec_n(aabb_max, params.params.add(), "aabb.max")
+    cnv_vec_n(center, params.params.add(), "sphere.center")
+    param = params.params.add()
+    param.name = "sphere.radius"
+    param.vfloat = radius
+
+
+def bounds_id(id):
+    """return the id of the CustomParamList with the bounds of the Mesh (or of the meshes of a blender mesh)"""
+    return "bounds_" + id
+
+
+def patch_id(mesh_id):
+    """return the id of the CustomParamList marking the Mesh as a patch of the mesh"""
+    return "patch_" + mesh_id
+
+
+def morphs_id(mesh_id):
+    """return the id of the CustomParamList with the names of the morphs of the mesh"""
+    return "morphs_" + mesh_id
+
+
+def quantization_id(mesh_id):
+    """return the id of the CustomParamList describing the quantized arrays of the mesh"""
+    return "quantization_" + mesh_id
+
+
+def cnv_vec_n(src, dst_param, name):
+    """set the custom param dst_param to the vec2, vec3 or vec4 src (numpy array)"""
+    dst_param.name = name
+    dst = [dst_param.vvec2, dst_param.vvec3, dst_param.vvec4][len(src) - 2]
+    for axis, value in zip("xyzw", src.tolist()):
+        setattr(dst, axis, value)
+
+
+class MeshPatcher:
+    """
+    keep digests of the vertex arrays of the meshes sent (by blocks of PATCH_BLOCK vertices, and the order of
+    the vertices once encoded), to encode the next versions of a mesh with the same topology as patches of the
+    blocks of vertices that changed: a Mesh with the id of the mesh, and for every attribute with changes
+    a vertex array (floats, step of the attribute) with the values of the changed vertices, and at the same
+    position into indexArrays the indices of these vertices (ints, step 1). The Mesh is related to the
+    CustomParamList "patch_<id>" with the param "encoding": PATCH.
+    """
+
+    def __init__(self):
+        # {id of mesh: (topology, [(attrib, shape, block digests)], index of every vertex into the encoded vertices
+        # or None if same order)}
+        self._states = {}
+
+    def patch(self, payload):
+        """return [(field of xbuf.Data, encoded message)] of the patch of payload, or None if the mesh should be sent"""
+        state = self._states.get(payload.id)
+        if state is None or payload.quantize or state[0] != topology_of(payload):
+            return None
+        (topology, digests, order) = state
+        rows = []
+        (changed_size, size) = (0, 0)
+        new_digests = vertex_digests(payload)
+        for (attrib, values), (attrib0, shape0, digest0), (_, _, digest) in zip(payload.arrays.vertex_arrays, digests, new_digests):
+            if attrib != attrib0 or values.shape != shape0:
+                return None
+            blocks = numpy.flatnonzero(digest != digest0)
+            changed = (blocks[:, numpy.newaxis] * PATCH_BLOCK + numpy.arange(PATCH_BLOCK)).ravel()
+            changed = changed[changed < len(values)]
+            index = changed
+            if order is not None:
+                # vertices not encoded (unused) have no index
+                changed = changed[order[changed] >= 0]
+                index = order[changed]
+            if len(changed) > 0:
+                rows.append((attrib, index, values[changed]))
+            changed_size += len(changed) * values.shape[1]
+            size += values.size
+        if len(payload.arrays.vertex_arrays) != len(digests) or changed_size > size * PATCH_MAX_RATIO:
+            return None
+        dst = xbuf.datas_pb2.Mesh()
+        dst.id = payload.id
+        dst.name = payload.name
+        dst.lod = payload.lod
+        for attrib, index, values in rows:
+            export_vertex_array(dst, attrib, values)
+            dst_index = dst.indexArrays.add()
+            dst_index.ints.step = 1
+            dst_index.ints.values.extend(index.tolist())
+        params = xbuf.datas_pb2.CustomParamList()
+        params.id = patch_id(dst.id)
+        param = params.params.add()
+        param.name = "encoding"
+        param.vstring = PATCH
+        encoded = [("meshes", dst.SerializeToString()), ("custom_params", params.SerializeToString())]
+        # the other messages of the mesh are sent again (unchanged but for the bounds)
+        if len(payload.morphs) > 0:
+            params = xbuf.datas_pb2.CustomParamList()
+            # the indices of the morphs are after the index of the triangles in the mesh sent (not quantized)
+            export_morphs_names(params, dst.id, payload.morphs, range(1, 1 + len(payload.morphs)))
+            encoded.append(("custom_params", params.SerializeToString()))
+        positions = dict(payload.arrays.vertex_arrays).get(xbuf.datas_pb2.VertexArray.position)
+        if positions is not None:
+            params = xbuf.datas_pb2.CustomParamList()
+            export_bounds(params, bounds_id(dst.id), mesh_utils.bounds(positions if order is None else positions[order >= 0]))
+            encoded.append(("custom_params", params.SerializeToString()))
+        self._states[payload.id] = (topology, new_digests, order)
+        return encoded
+
+    def sent(self, payload, kept):
+        """record the payload sent (encoded with the vertices kept, see encode_mesh)"""
+        order = None
+        if kept is not None:
+            order = numpy.full(payload.arrays.vertices_count(), -1, dtype=numpy.int32)
+            order[kept] = numpy.arange(len(kept), dtype=numpy.int32)
+        self._states[payload.id] = (topology_of(payload), vertex_digests(payload), order)
+
+    def forget(self, mesh_id):
+        """forget the mesh (sent without its arrays, eg from a cache)"""
+        self._states.pop(mesh_id, None)
+
+    def retain(self, keep):
+        """forget the meshes with id not keep(id)"""
+        for mesh_id in [mesh_id for mesh_id in self._states if not keep(mesh_id)]:
+            del self._states[mesh_id]
+
+
+def vertex_digests(payload):
+    """return [(attrib, shape of values, digests of the blocks of PATCH_BLOCK vertices)] of the vertex arrays of payload"""
+    return [(attrib, values.shape, mesh_utils.block_digests(values, PATCH_BLOCK)) for attrib, values in payload.arrays.vertex_arrays]
+
+
+def topology_of(payload):
+    """return a digest of everything in payload but its vertex arrays (that a patch can't change)"""
+    h = hashlib.sha1()
+    h.update(repr((payload.lod, payload.quantize, payload.vertex_cache_size, payload.triangle_strips, [attrib for attrib, _ in payload.arrays.vertex_arrays])).encode("utf-8"))
+    h.update(numpy.ascontiguousarray(payload.arrays.triangles).tobytes())
+    for array in (payload.skin or ()):
+        h.update(numpy.ascontiguousarray(array).tobytes())
+    for name, moved, deltas in payload.morphs:
+        h.update(name.encode("utf-8"))
+        h.update(numpy.ascontiguousarray(moved).tobytes())
+        h.update(numpy.ascontiguousarray(deltas).tobytes())
+    return h.hexdigest()
+
+
+class MeshEncoder:
+    """
+    encode MeshPayload in a pool of processes (or in the current process without pool),
+    the encoded messages are returned in the order of submission (so the output is deterministic).
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self._pending = []
+        self._callbacks = []
+
+    def submit(self, payloads, done=None):
+        """
+        encode payloads, done([(encoded messages, vertices kept) of every payload]) will be called by results()
+        """
+        start = len(self._pending)
+        for payload in payloads:
+            if self.pool is None:
+                self._pending.append(encode_mesh(payload))
+            else:
+                self._pending.append(self.pool.submit(encode_mesh, payload))
+        if done is not None:
+            self._callbacks.append((start, len(self._pending), done))
+
+    def add(self, encoded):
+        """add already encoded messages [(field of xbuf.Data, encoded message)]"""
+        self._pending.append((encoded, [], None))
+
+    def results(self, info):
+        """wait the end of the encoding, return [(field of xbuf.Data, encoded message)] (in order of submission)"""
+        results = []
+        for pending in self._pending:
+            (encoded, infos, kept) = pending.result() if isinstance(pending, concurrent.futures.Future) else pending
+            for txt in infos:
+                info(txt)
+            results.append((encoded, kept))
+        for start, end, done in self._callbacks:
+            done(results[start:end])
+        self._pending = []
+        self._callbacks = []
+        return [message for encoded, _ in results for message in encoded]
+
+
+def make_pool(workers):
+    """return a pool of workers processes, or None (encode in the current process) if workers < 1"""
+    # workers must be forked (the addon modules are not importable from a new python process)
+    if workers < 1 or os.name != 'posix':
+        return None
+    try:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    except TypeError:
+        # python < 3.7 (blender 2.7x) has no mp_context, its pools always fork on posix
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+
+def varint_bytes(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encoded_id(raw):
+    """return the id (field 1, serialized first) of the encoded message raw (xbuf.Mesh, CustomParamList,...)"""
+    if len(raw) == 0 or raw[0] != 0x0a:
+        return ""
+    (size, pos, shift) = (0, 1, 0)
+    while raw[pos] & 0x80:
+        size |= (raw[pos] & 0x7f) << shift
+        pos += 1
+        shift += 7
+    size |= raw[pos] << shift
+    return raw[pos + 1:pos + 1 + size].decode("utf-8")
+
+
+def serialize_with(message, encoded):
+    """
+    return message serialized with the encoded messages (fields of message) appended,
+    protobuf concatenates repeated fields, so the result is parsed as if encoded were added to message.
+    """
+    fields = message.DESCRIPTOR.fields_by_name
+    out = [message.SerializeToString()]
+    for field, raw in encoded:
+        # wire type 2: length-delimited
+        out.append(varint_bytes(fields[field].number << 3 | 2))
+        out.append(varint_bytes(len(raw)))
+        out.append(raw)
+    return b"".join(out)
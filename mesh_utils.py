@@ -0,0 +1,598 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# processing of mesh arrays (numpy only, no bpy), used by xbuf_export
+
+import numpy
+
+
+class MeshArrays:
+    """the arrays of a mesh extracted from blender, before encoding into a xbuf.Mesh"""
+
+    def __init__(self, vertex, vertex_arrays, triangles):
+        # index of the blender vertex of each vertex (shape (n,))
+        self.vertex = vertex
+        # list of (xbuf.VertexArray.attrib, values (shape (n, step)))
+        self.vertex_arrays = vertex_arrays
+        # indices of vertices (shape (m, 3))
+        self.triangles = triangles
+
+    def vertices_count(self):
+        return len(self.vertex)
+
+    def select(self, kept, triangles):
+        """return a MeshArrays with only the kept vertices and the (remapped) triangles"""
+        return MeshArrays(self.vertex[kept], [(attrib, values[kept]) for (attrib, values) in self.vertex_arrays], triangles)
+
+
+def rows_as_keys(columns):
+    """return one hashable (void) key per row of the concatenated columns (same bytes => same key)"""
+    n = len(columns[0])
+    rows = numpy.hstack([numpy.ascontiguousarray(c).reshape((n, -1)).view(numpy.uint8) for c in columns])
+    rows = numpy.ascontiguousarray(rows)
+    return rows.view(numpy.dtype((numpy.void, rows.shape[1])))[:, 0]
+
+
+def unique_rows(columns):
+    """
+    return (kept, inverse) so that columns[i][kept] are the unique rows (in order of first occurrence)
+    and columns[i][kept][inverse] == columns[i]
+    """
+    _, first, inverse = numpy.unique(rows_as_keys(columns), return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return first[order], rank[inverse.ravel()]
+
+
+def weld(arrays):
+    """
+    merge the vertices with the same blender vertex and the same values in every vertex arrays
+    (so same position, skin, tbn, color, texcoords,...).
+    return the welded MeshArrays.
+    """
+    if arrays.vertices_count() == 0:
+        return arrays
+    columns = [arrays.vertex.astype(numpy.int64)] + [values for (_, values) in arrays.vertex_arrays]
+    (kept, inverse) = unique_rows(columns)
+    return arrays.select(kept, inverse[arrays.triangles])
+
+
+def gather_ranges(start, count):
+    """return the concatenation of the ranges [start[i], start[i] + count[i])"""
+    offset = numpy.cumsum(count) - count
+    return numpy.arange(numpy.sum(count), dtype=numpy.int64) + numpy.repeat(start - offset, count)
+
+
+class VertexInfluences:
+    """bone influences (sorted by decreasing weight, normalized) of every blender vertex"""
+
+    def __init__(self, count, bone_index, bone_weight):
+        # number of influences of each vertex (shape (nv,))
+        self.count = count
+        self.start = numpy.cumsum(count) - count
+        # concatenated influences of the vertices
+        self.bone_index = bone_index
+        self.bone_weight = bone_weight
+
+    @staticmethod
+    def from_groups(vertices_count, vertex, group, weight, group_to_bone):
+        """
+        build the influences from the (vertex, group, weight) of every vertex groups,
+        groups not bound to a bone (group_to_bone < 0) and null weights are ignored.
+        """
+        bone = group_to_bone[group]
+        kept = (bone >= 0) & (weight > 0)
+        (vertex, bone, weight) = (vertex[kept], bone[kept], weight[kept])
+        # by vertex, then by decreasing weight (stable, like sorted(..., reverse=True))
+        order = numpy.lexsort((-weight, vertex))
+        (vertex, bone, weight) = (vertex[order], bone[order], weight[order])
+        total = numpy.bincount(vertex, weights=weight, minlength=vertices_count)
+        count = numpy.bincount(vertex, minlength=vertices_count)
+        return VertexInfluences(count, bone, weight * (1.0 / total[vertex]))
+
+    def gather(self, vertex):
+        """return (count, bone_index, bone_weight) of the vertices"""
+        count = self.count[vertex]
+        selected = gather_ranges(self.start[vertex], count)
+        return (count, self.bone_index[selected], self.bone_weight[selected])
+
+    def limit(self, max_count):
+        """
+        keep the max_count strongest influences of every vertex (renormalized), padded with (0, 0.0)
+        return (bone_index, bone_weight) (shape (nv, max_count)) and the weight error of every vertex
+        (the max difference with the original weights, including the dropped ones)
+        """
+        slot = numpy.arange(max_count)
+        valid = slot < self.count[:, numpy.newaxis]
+        selected = (self.start[:, numpy.newaxis] + slot)[valid]
+        bone_index = numpy.zeros((len(self.count), max_count), dtype=self.bone_index.dtype)
+        bone_index[valid] = self.bone_index[selected]
+        original = numpy.zeros((len(self.count), max_count))
+        original[valid] = self.bone_weight[selected]
+        total = numpy.sum(original, axis=1)
+        bone_weight = original / numpy.where(total > 0, total, 1.0)[:, numpy.newaxis]
+        error = numpy.max(numpy.abs(bone_weight - original), axis=1) if max_count > 0 else numpy.zeros(len(self.count))
+        # weights are sorted, so the first dropped influence is the strongest
+        dropped = self.count > max_count
+        error[dropped] = numpy.maximum(error[dropped], self.bone_weight[self.start[dropped] + max_count])
+        return (bone_index, bone_weight, error)
+
+
+def quantize_unorm(values, bits=16):
+    """
+    quantize every component relative to its bounds (min, max) into [0, 2**bits - 1].
+    return (offset, scale, quantized) with values ~= offset + quantized * scale (per component),
+    quantized has the shape of values (one uint per component, rows of step components).
+    """
+    top = (1 << bits) - 1
+    offset = values.min(axis=0)
+    scale = (values.max(axis=0) - offset) / top
+    quantized = numpy.rint((values - offset) / numpy.where(scale > 0, scale, 1.0))
+    return (offset, scale, numpy.clip(quantized, 0, top).astype(numpy.uint32))
+
+
+def dequantize_unorm(offset, scale, quantized):
+    return offset + quantized * scale
+
+
+def quantize_quat_smallest_three(quats, bits=10):
+    """
+    pack unit quaternions (rows (x, y, z, w)) into one uint32 (with bits <= 10) per quaternion:
+    the index of the largest component (2 bits) then the 3 other components (in [-1/sqrt(2), 1/sqrt(2)]),
+    the largest component is positive (q and -q are the same rotation) and it is rebuilt from the others.
+    With bits = 10, from the most significant bit:
+    - bits 31..30: index (0: x, 1: y, 2: z, 3: w) of the largest component
+    - bits 29..20, 19..10, 9..0: the other components in order, c = (u / 1023 - 0.5) * sqrt(2)
+    - largest component = sqrt(1 - sum of the squares of the others)
+    """
+    top = (1 << bits) - 1
+    largest = numpy.argmax(numpy.abs(quats), axis=1)
+    rows = numpy.arange(len(quats))
+    quats = quats * numpy.where(quats[rows, largest] < 0, -1.0, 1.0)[:, numpy.newaxis]
+    others = quats[numpy.arange(4) != largest[:, numpy.newaxis]].reshape((-1, 3))
+    quantized = numpy.rint((others * numpy.sqrt(0.5) + 0.5) * top)
+    quantized = numpy.clip(quantized, 0, top).astype(numpy.uint32)
+    packed = largest.astype(numpy.uint32) << (3 * bits)
+    for i in range(3):
+        packed |= quantized[:, i] << ((2 - i) * bits)
+    return packed
+
+
+def dequantize_quat_smallest_three(packed, bits=10):
+    top = (1 << bits) - 1
+    largest = (packed >> (3 * bits)).astype(numpy.int64)
+    others = numpy.column_stack([(packed >> ((2 - i) * bits)) & top for i in range(3)])
+    others = (others / top - 0.5) / numpy.sqrt(0.5)
+    quats = numpy.empty((len(packed), 4))
+    mask = numpy.arange(4) != largest[:, numpy.newaxis]
+    quats[mask] = others.ravel()
+    quats[numpy.arange(len(packed)), largest] = numpy.sqrt(numpy.maximum(0.0, 1.0 - numpy.sum(others * others, axis=1)))
+    return quats
+
+
+def varint_size(values):
+    """return the size (in bytes) of the values encoded as protobuf varints"""
+    size = numpy.ones(len(values), dtype=numpy.int64)
+    for shift in (7, 14, 21, 28):
+        size += values >= (1 << shift)
+    return int(numpy.sum(size))
+
+
+def plane_quadrics(positions, triangles):
+    """return the quadric (4x4, area weighted) of the plane of every triangle"""
+    p = positions[triangles].astype(numpy.float64)
+    normals = numpy.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+    area2 = numpy.sqrt(numpy.sum(normals * normals, axis=1))
+    normals /= numpy.where(area2 > 0, area2, 1.0)[:, numpy.newaxis]
+    planes = numpy.column_stack((normals, -numpy.sum(normals * p[:, 0], axis=1)))
+    return planes[:, :, numpy.newaxis] * planes[:, numpy.newaxis, :] * (0.5 * area2)[:, numpy.newaxis, numpy.newaxis]
+
+
+def locked_vertices(positions, triangles):
+    """
+    return the mask of vertices that should not be moved by decimation:
+    vertices on borders and on seams (several vertices at the same position, eg with different texcoords)
+    """
+    (_, same) = unique_rows([positions])
+    locked = numpy.bincount(same)[same] > 1
+    # borders: edges (between positions) used by only one triangle
+    edges = triangles[:, [0, 1, 1, 2, 2, 0]].reshape((-1, 2))
+    (_, inverse) = unique_rows([numpy.sort(same[edges], axis=1)])
+    border = numpy.bincount(inverse)[inverse] == 1
+    locked[edges[border].ravel()] = True
+    return locked
+
+
+def decimate(arrays, positions, target_triangles):
+    """
+    simplify the (welded) mesh by edge collapse until it has at most target_triangles (or nothing can be collapsed),
+    positions are the positions of the vertices of arrays, return the simplified MeshArrays.
+    Every step collapses a batch of independent half-edges (b -> a, no shared triangle) among the ones
+    with the lowest quadric error, vertices keep their values (so skin, texcoords,... stay valid),
+    borders and seams are preserved, collapses that flip a triangle are rejected.
+    """
+    positions = positions.astype(numpy.float64)
+    triangles = arrays.triangles
+    quadrics = numpy.zeros((len(positions), 4, 4))
+    numpy.add.at(quadrics, triangles, plane_quadrics(positions, triangles)[:, numpy.newaxis])
+    locked = locked_vertices(positions, triangles) if len(triangles) > 0 else None
+    normals = numpy.zeros((len(positions), 3))
+    numpy.add.at(normals, triangles, triangle_normals(positions, triangles)[:, numpy.newaxis])
+    normals /= numpy.maximum(numpy.sqrt(numpy.sum(normals * normals, axis=1)), 1e-30)[:, numpy.newaxis]
+    # fixed pseudo random order of the vertices, to break ties and spread the collapses of a step
+    shuffle = numpy.random.RandomState(0).permutation(len(positions))
+    while len(triangles) > target_triangles:
+        # half-edges b -> a (b is removed)
+        edges = triangles[:, [0, 1, 1, 2, 2, 0, 1, 0, 2, 1, 0, 2]].reshape((-1, 2))
+        edges = edges[~locked[edges[:, 0]]]
+        (b, a) = (edges[:, 0], edges[:, 1])
+        p = numpy.column_stack((positions[a], numpy.ones(len(a))))
+        cost = numpy.einsum('ni,nij,nj->n', p, quadrics[b], p)
+        # the b with the cheapest quarter of edges, then their cheapest edge without flip
+        best = numpy.full(len(positions), numpy.inf)
+        numpy.minimum.at(best, b, cost)
+        cheap = numpy.zeros(len(positions), dtype=bool)
+        cheap[numpy.argsort(best, kind='mergesort')[:numpy.count_nonzero(numpy.isfinite(best)) // 4 + 1]] = True
+        (b, a, cost) = (b[cheap[b]], a[cheap[b]], cost[cheap[b]])
+        cost[collapse_flips(positions, triangles, b, a, normals)] = numpy.inf
+        order = numpy.lexsort((a, b, cost))
+        order = order[numpy.isfinite(cost[order])]
+        (_, first) = numpy.unique(b[order], return_index=True)
+        (b, a) = (b[order[first]], a[order[first]])
+        if len(b) == 0:
+            break
+        owner = numpy.full(len(positions), len(positions), dtype=numpy.int64)
+        owner[b] = shuffle[b]
+        face_owner = numpy.min(owner[triangles], axis=1)
+        around = numpy.full(len(positions), len(positions), dtype=numpy.int64)
+        numpy.minimum.at(around, triangles.ravel(), numpy.repeat(face_owner, 3))
+        accepted = (around[b] == shuffle[b]) & (around[a] == shuffle[b])
+        # don't go (much) under the target: every collapse removes ~2 triangles
+        accepted = numpy.flatnonzero(accepted)[:max(1, (len(triangles) - target_triangles + 1) // 2)]
+        collapse = numpy.arange(len(positions))
+        collapse[b[accepted]] = a[accepted]
+        numpy.add.at(quadrics, a[accepted], quadrics[b[accepted]])
+        triangles = collapse[triangles]
+        triangles = triangles[(triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 2] != triangles[:, 0])]
+    used = numpy.zeros(len(positions), dtype=bool)
+    used[triangles.ravel()] = True
+    kept = numpy.flatnonzero(used)
+    remap = numpy.cumsum(used) - 1
+    return arrays.select(kept, remap[triangles])
+
+
+def collapse_flips(positions, triangles, b, a, normals):
+    """
+    return the mask of the half-edges b -> a whose collapse flips a triangle around b
+    (relative to the triangle or to the original normals (unit) of its vertices) or makes it degenerate
+    """
+    corners = numpy.argsort(triangles.ravel(), kind='mergesort')
+    count = numpy.bincount(triangles.ravel(), minlength=len(positions))
+    start = numpy.cumsum(count) - count
+    pair_edge = numpy.repeat(numpy.arange(len(b)), count[b])
+    pair_triangle = corners[gather_ranges(start[b], count[b])] // 3
+    before = triangles[pair_triangle]
+    after = numpy.where(before == b[pair_edge, numpy.newaxis], a[pair_edge, numpy.newaxis], before)
+    # triangles with b and a are removed by the collapse
+    kept = numpy.all(before != a[pair_edge, numpy.newaxis], axis=1)
+    (before, after, pair_edge) = (before[kept], after[kept], pair_edge[kept])
+    n0 = triangle_normals(positions, before)
+    n1 = triangle_normals(positions, after)
+    # flipped or rotated too much (more than ~80 degrees)
+    flipped = numpy.sum(n0 * n1, axis=1) <= 0.2 * numpy.sqrt(numpy.sum(n0 * n0, axis=1) * numpy.sum(n1 * n1, axis=1))
+    for i in range(3):
+        flipped |= numpy.sum(n1 * normals[after[:, i]], axis=1) <= 0.2 * numpy.sqrt(numpy.sum(n1 * n1, axis=1))
+    # or (almost) degenerate, eg its corners aligned on a border (the rotation of its normal is meaningless)
+    p = positions[after]
+    edges2 = numpy.sum((p - p[:, [1, 2, 0]]) ** 2, axis=(1, 2))
+    flipped |= numpy.sqrt(numpy.sum(n1 * n1, axis=1)) <= 0.01 * edges2
+    return numpy.bincount(pair_edge[flipped], minlength=len(b)) > 0
+
+
+def triangle_normals(positions, triangles):
+    p = positions[triangles]
+    return numpy.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+
+
+def split(arrays, max_vertices):
+    """
+    split the mesh into chunks (MeshArrays) of consecutive triangles with at most max_vertices (>= 3) vertices each,
+    (so the indices of every chunk are lower than max_vertices), return [arrays] if it's not needed.
+    """
+    if arrays.vertices_count() <= max_vertices:
+        return [arrays]
+    chunks = []
+    start = 0
+    triangles = arrays.triangles
+    while start < len(triangles):
+        # bounded work per chunk: a chunk ends at the end of the window if its triangles use fewer vertices,
+        # (a welded closed mesh has about 2 triangles per vertex, so the window is rarely too small)
+        window = triangles[start:start + 4 * max_vertices].ravel()
+        (first, _) = unique_rows([window])
+        is_new = numpy.zeros(len(window), dtype=numpy.int64)
+        is_new[first] = 1
+        # vertices used by the triangles [start, start + i] (at their last corner)
+        used = numpy.cumsum(is_new)[2::3]
+        end = start + max(1, int(numpy.searchsorted(used, max_vertices, side='right')))
+        chunk = triangles[start:end]
+        (kept, inverse) = unique_rows([chunk.ravel()])
+        chunks.append(arrays.select(chunk.ravel()[kept], inverse.reshape((-1, 3))))
+        start = end
+    return chunks
+
+
+def tipsify(triangles, vertices_count, cache_size=16):
+    """
+    return the order of the triangles that reduces the misses of a post-transform vertex cache (fifo of cache_size),
+    Tipsify from "Fast Triangle Reordering for Vertex Locality and Reduced Overdraw" (Sander, Nehab, Barczak 2007):
+    triangles are emitted by fans around vertices, the next fan is the vertex that will still be in the cache.
+    return (order, misses of the cache with this order), so acmr of the result is misses / len(triangles).
+    """
+    corners = numpy.argsort(triangles.ravel(), kind='mergesort')
+    count = numpy.bincount(triangles.ravel(), minlength=vertices_count)
+    start = (numpy.cumsum(count) - count).tolist()
+    adjacency = (corners // 3).tolist()
+    count = count.tolist()
+    triangles_list = triangles.tolist()
+    live = list(count)
+    timestamp = [0] * vertices_count
+    emitted = [False] * len(triangles_list)
+    dead_ends = []
+    order = []
+    time = cache_size + 1
+    cursor = 0
+    fan = 0 if vertices_count > 0 else -1
+    while fan >= 0:
+        candidates = []
+        for t in adjacency[start[fan]:start[fan] + count[fan]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            order.append(t)
+            for v in triangles_list[t]:
+                dead_ends.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - timestamp[v] > cache_size:
+                    timestamp[v] = time
+                    time += 1
+        # the candidate that will be the oldest in the cache after its fan (still in the cache)
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = time - timestamp[v] if time - timestamp[v] + 2 * live[v] <= cache_size else 0
+                if priority > best:
+                    (best, fan) = (priority, v)
+        if fan < 0:
+            while dead_ends and fan < 0:
+                v = dead_ends.pop()
+                if live[v] > 0:
+                    fan = v
+            while fan < 0 and cursor < vertices_count:
+                if live[cursor] > 0:
+                    fan = cursor
+                cursor += 1
+    return (numpy.array(order, dtype=numpy.int64), time - (cache_size + 1))
+
+
+def acmr(triangles, cache_size=16):
+    """
+    return the average cache miss ratio (vertices transformed per triangle) with a fifo cache of cache_size,
+    counted with the timestamps of tipsify (a vertex is in the cache while less than cache_size vertices entered after it)
+    """
+    if len(triangles) == 0:
+        return 0.0
+    timestamp = [0] * (int(triangles.max()) + 1)
+    time = cache_size + 1
+    for v in triangles.ravel().tolist():
+        if time - timestamp[v] > cache_size:
+            timestamp[v] = time
+            time += 1
+    return (time - (cache_size + 1)) / len(triangles)
+
+
+def optimize_vertex_cache(arrays, cache_size=16):
+    """
+    return (arrays with the triangles reordered for the post-transform vertex cache (see tipsify)
+    and the vertices reordered in order of first use (for the pre-transform / fetch cache),
+    the indices of the original vertices in the new order, the acmr of the new order)
+    """
+    (order, misses) = tipsify(arrays.triangles, arrays.vertices_count(), cache_size)
+    triangles = arrays.triangles[order]
+    (first, inverse) = unique_rows([triangles.ravel()])
+    kept = triangles.ravel()[first]
+    return (arrays.select(kept, inverse.reshape((-1, 3))), kept, misses / max(1, len(triangles)))
+
+
+# index separating the strips of a triangle strip (primitive restart, like the fixed index of OpenGL/Vulkan)
+STRIP_RESTART = 0xffffffff
+
+
+def stripify(triangles):
+    """
+    return the indices (uint32) of triangle strips (separated by STRIP_RESTART) with the same triangles (and winding),
+    strips are greedy, started from the first free triangle (so they follow the order of triangles).
+    """
+    triangles_list = triangles.tolist()
+    # directed edge (a, b) -> triangles (a, b, c) (any rotation)
+    by_edge = {}
+    for t, (a, b, c) in enumerate(triangles_list):
+        by_edge.setdefault((a, b), []).append((t, c))
+        by_edge.setdefault((b, c), []).append((t, a))
+        by_edge.setdefault((c, a), []).append((t, b))
+    used = [False] * len(triangles_list)
+
+    def next_of(p, q):
+        for t, r in by_edge.get((p, q), ()):
+            if not used[t]:
+                return (t, r)
+        return None
+
+    def grow(strip, taken):
+        # triangle k of a strip is (s[k], s[k + 1], s[k + 2]) if k is even else (s[k + 1], s[k], s[k + 2])
+        while True:
+            k = len(strip) - 2
+            found = next_of(strip[k], strip[k + 1]) if k % 2 == 0 else next_of(strip[k + 1], strip[k])
+            if found is None:
+                return strip
+            used[found[0]] = True
+            taken.append(found[0])
+            strip.append(found[1])
+
+    out = []
+    for t, (a, b, c) in enumerate(triangles_list):
+        if used[t]:
+            continue
+        used[t] = True
+        # start with the rotation of t that gives the longest strip
+        best = None
+        for start in ([a, b, c], [b, c, a], [c, a, b]):
+            taken = []
+            strip = grow(start, taken)
+            for u in taken:
+                used[u] = False
+            if best is None or len(strip) > len(best[0]):
+                best = (strip, taken)
+        for u in best[1]:
+            used[u] = True
+        strip = best[0]
+        if out:
+            out.append(STRIP_RESTART)
+        out.extend(strip)
+    return numpy.array(out, dtype=numpy.uint32)
+
+
+def unstripify(strips):
+    """return the triangles (shape (m, 3)) of triangle strips separated by STRIP_RESTART"""
+    triangles = []
+    strip = []
+    for v in strips.tolist() + [STRIP_RESTART]:
+        if v != STRIP_RESTART:
+            strip.append(v)
+            continue
+        for k in range(len(strip) - 2):
+            triangles.append((strip[k], strip[k + 1], strip[k + 2]) if k % 2 == 0 else (strip[k + 1], strip[k], strip[k + 2]))
+        strip = []
+    return numpy.array(triangles, dtype=numpy.int64).reshape((-1, 3))
+
+
+def block_digests(values, block=16):
+    """
+    return a 64 bits digest of every block of `block` rows of values (shape (n, step), items of 4 or 8 bytes),
+    to find the blocks that changed without keeping a copy of values (the last block is padded with zeros)
+    """
+    words = numpy.ascontiguousarray(values).view(numpy.uint32).reshape((len(values), -1))
+    blocks = -(-len(values) // block)
+    padded = numpy.zeros((blocks * block, words.shape[1]), dtype=numpy.uint64)
+    padded[:len(values)] = words
+    x = padded.reshape((blocks, -1))
+    # splitmix64 of every word (salted by its position into the block), summed
+    x = x + (numpy.arange(x.shape[1], dtype=numpy.uint64) + numpy.uint64(1)) * numpy.uint64(0x9e3779b97f4a7c15)
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94d049bb133111eb)
+    x ^= x >> numpy.uint64(31)
+    return numpy.sum(x, axis=1, dtype=numpy.uint64)
+
+
+def bounds(positions):
+    """
+    return the bounding volumes of positions (shape (n, 3)): (aabb min, aabb max, sphere center, sphere radius),
+    the sphere is centered on the aabb (not the minimal sphere, but cheap and stable)
+    """
+    if len(positions) == 0:
+        zero = numpy.zeros(3, dtype=numpy.float32)
+        return (zero, zero, zero, 0.0)
+    aabb_min = positions.min(axis=0)
+    aabb_max = positions.max(axis=0)
+    center = (aabb_min + aabb_max) * 0.5
+    delta = positions - center
+    radius = float(numpy.sqrt(numpy.max(numpy.sum(delta * delta, axis=1))))
+    return (aabb_min, aabb_max, center, radius)
+
+
+# The functions below are the batch versions of xbuf_export.tbn_from_normal, tbn_from_loop
+# and cnv_toQuatZupToYup, quaternions are stored as (w, x, y, z) rows (like mathutils),
+# except the result of cnv_toQuatZupToYup_array stored as (x, y, z, w) (like xbuf).
+# They follow the mathutils (float) computation, including the sign of the quaternions.
+
+def tbn_from_normal_array(normals):
+    """same as tbn_from_normal for an array of normals (shape (n, 3))"""
+    n = normals.astype(numpy.float64)
+    n /= numpy.maximum(numpy.linalg.norm(n, axis=1), 1e-35)[:, numpy.newaxis]
+    m = numpy.sqrt(numpy.maximum(2.0 + 2.0 * n[:, 2], 0.0))
+    m_inv = 1.0 / numpy.where(m == 0, 1.0, m)
+    # n.cross((0, 0, 1)) is (n.y, -n.x, 0), and the invert of a unit quaternion is its conjugate
+    q = numpy.column_stack((0.5 * m, -n[:, 1] * m_inv, n[:, 0] * m_inv, numpy.zeros(len(n))))
+    q[m == 0] = (0.0, 0.0, -1.0, 0.0)
+    return q
+
+
+def tbn_from_loop_array(normals, tangents, bitangent_signs):
+    """same as tbn_from_loop for arrays of normals, tangents (shape (n, 3)) and bitangent_signs (shape (n,))"""
+    n = normals.astype(numpy.float64)
+    t = tangents.astype(numpy.float64)
+    b = bitangent_signs[:, numpy.newaxis] * numpy.cross(n, t)
+    q = mat3_to_quat_array(numpy.stack((t, b, n), axis=1))
+    q[:, 1:] *= -1.0
+    return q
+
+
+def mat3_to_quat_array(rows):
+    """same as mathutils.Matrix(rows).to_quaternion() for an array of 3x3 matrices (shape (n, 3, 3))"""
+    # mathutils normalizes the columns, then works on mat[column][row]
+    norms = numpy.linalg.norm(rows, axis=1)
+    mat = numpy.transpose(rows / numpy.where(norms == 0, 1.0, norms)[:, numpy.newaxis, :], (0, 2, 1))
+    m00, m01, m02 = mat[:, 0, 0], mat[:, 0, 1], mat[:, 0, 2]
+    m10, m11, m12 = mat[:, 1, 0], mat[:, 1, 1], mat[:, 1, 2]
+    m20, m21, m22 = mat[:, 2, 0], mat[:, 2, 1], mat[:, 2, 2]
+    tr = 0.25 * (1.0 + m00 + m11 + m22)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        s = numpy.sqrt(tr)
+        q_tr = numpy.column_stack((s, (m12 - m21) / (4.0 * s), (m20 - m02) / (4.0 * s), (m01 - m10) / (4.0 * s)))
+        s = 2.0 * numpy.sqrt(1.0 + m00 - m11 - m22)
+        q_x = numpy.column_stack(((m12 - m21) / s, 0.25 * s, (m10 + m01) / s, (m20 + m02) / s))
+        s = 2.0 * numpy.sqrt(1.0 + m11 - m00 - m22)
+        q_y = numpy.column_stack(((m20 - m02) / s, (m10 + m01) / s, 0.25 * s, (m21 + m12) / s))
+        s = 2.0 * numpy.sqrt(1.0 + m22 - m00 - m11)
+        q_z = numpy.column_stack(((m01 - m10) / s, (m20 + m02) / s, (m21 + m12) / s, 0.25 * s))
+    pivot_x = (m00 > m11) & (m00 > m22)
+    pivot_y = ~pivot_x & (m11 > m22)
+    q = numpy.where(pivot_x[:, numpy.newaxis], q_x, numpy.where(pivot_y[:, numpy.newaxis], q_y, q_z))
+    q = numpy.where((tr > 1e-4)[:, numpy.newaxis], q_tr, q)
+    return q / numpy.linalg.norm(q, axis=1)[:, numpy.newaxis]
+
+
+def cnv_toQuatZupToYup_array(src):
+    """same as cnv_toQuatZupToYup for an array of quaternions (shape (n, 4)), return (x, y, z, w) float32 rows"""
+    q = src / numpy.linalg.norm(src, axis=1)[:, numpy.newaxis]
+    r = numpy.sqrt(0.5)
+    # Quaternion((-1, 1, 0, 0)).normalized() * q
+    w = -r * (q[:, 0] + q[:, 1])
+    x = r * (q[:, 0] - q[:, 1])
+    y = -r * (q[:, 2] + q[:, 3])
+    z = r * (q[:, 2] - q[:, 3])
+    # Quaternion.rotate goes through a rotation matrix (then mat3_to_quat), so the sign of the
+    # result is the one choosen by mat3_to_quat for this matrix: positive w or positive pivot
+    d0 = 1.0 - 2.0 * (y * y + z * z)
+    d1 = 1.0 - 2.0 * (x * x + z * z)
+    d2 = 1.0 - 2.0 * (x * x + y * y)
+    pivot = numpy.where((d0 > d1) & (d0 > d2), x, numpy.where(d1 > d2, y, z))
+    pivot = numpy.where(0.25 * (1.0 + d0 + d1 + d2) > 1e-4, w, pivot)
+    sign = numpy.where(pivot < 0, -1.0, 1.0)
+    return (numpy.column_stack((x, y, z, w)) * sign[:, numpy.newaxis]).astype(numpy.float32)
@@ -16,6 +16,7 @@
 # <pep8 compliant>
 
 import struct
+import hashlib
 import asyncio
 import atexit
 import xbuf
@@ -23,6 +24,7 @@ import xbuf.datas_pb2
 import xbuf.cmds_pb2
 
 from . import xbuf_export  # pylint: disable=W0406
+from . import mesh_encoding  # pylint: disable=W0406
 
 # TODO better management off the event loop (eg  on unregister)
 loop = asyncio.get_event_loop()
@@ -45,6 +47,8 @@ class Client:
         self.reader = None
         self.host = None
         self.port = None
+        # what the receiver has (reset on every new connection)
+        self.sent = SentData()
 
     def __del__(self):
         self.close()
@@ -65,9 +69,69 @@ class Client:
             self.host = host
             self.port = port
             (self.reader, self.writer) = yield from asyncio.open_connection(host, port, loop=loop)
+            self.sent = SentData()
         return self
 
 
+# repeated fields of xbuf.Data with entities (with an id)
+ENTITY_FIELDS = ["tobjects", "materials", "lights", "skeletons", "meshes", "custom_params", "animations_kf"]
+
+
+def data_entries(data, encoded):
+    """
+    return [(key, field of xbuf.Data, encoded message)] for the entities and relations of data and encoded (see xbuf_export.export),
+    key identifies the entity (or relation) over exports
+    """
+    entries = []
+    for field in ENTITY_FIELDS:
+        for entity in getattr(data, field):
+            entries.append(((field, entity.id), field, entity.SerializeToString()))
+    for physics in data.physics:
+        entity = physics.rigidbody if physics.HasField("rigidbody") else physics.constraint
+        entries.append((("physics", entity.id), "physics", physics.SerializeToString()))
+    for rel in data.relations:
+        entries.append((("relations", rel.ref1, rel.ref2, rel.label), "relations", rel.SerializeToString()))
+    for field, raw in encoded:
+        entries.append(((field, mesh_encoding.encoded_id(raw)), field, raw))
+    return entries
+
+
+class SentData:
+    """
+    hashes of the entities and relations sent on a connection (written on the socket, there is no acknowledgment),
+    to not send again the ones identical to the last sent (eg property toggled back, undo,...),
+    with counters of the bytes sent and suppressed.
+    """
+
+    def __init__(self):
+        self._hashes = {}
+        self.sent_bytes = 0
+        self.suppressed_bytes = 0
+        self.suppressed_count = 0
+
+    def filter(self, entries):
+        """return [(field, encoded message)] of the entries (see data_entries) not sent before"""
+        kept = []
+        for key, field, raw in entries:
+            digest = hashlib.sha1(raw).digest()
+            if self._hashes.get(key) == digest:
+                self.suppressed_bytes += len(raw)
+                self.suppressed_count += 1
+            else:
+                self._hashes[key] = digest
+                self.sent_bytes += len(raw)
+                kept.append((field, raw))
+        return kept
+
+    def forget(self, refs, relations):
+        """forget the deleted entities and relations (so they are sent if they are created again)"""
+        for ref in refs:
+            for field in ENTITY_FIELDS + ["physics"]:
+                self._hashes.pop((field, ref), None)
+        for ref1, ref2 in relations:
+            self._hashes.pop(("relations", ref1, ref2, ""), None)
+
+
 @asyncio.coroutine
 def readHeader(reader):
     """return (size, kind)"""
@@ -110,18 +174,59 @@ def setEye(writer, location, rotation, projection_matrix, near, far, is_ortho):
     writeMessage(writer, Kind.xbuf_cmd, cmd.SerializeToString())
 
 
-def setData(writer, scene, cfg):
-    cmd = xbuf.cmds_pb2.Cmd()
-    xbuf_export.export(scene, cmd.setData, cfg)
-    send = (len(cmd.setData.relations) > 0 or
-            len(cmd.setData.tobjects) > 0 or
-            len(cmd.setData.geometries) > 0 or
-            len(cmd.setData.materials) > 0 or
-            len(cmd.setData.lights) > 0
-            )
-    if send:
-        # print("send setData")
+def setData(writer, scene, cfg, sent=None):
+    """export and send the changes of the scene, without the entities identical to the ones already sent (if sent: SentData)"""
+    data = xbuf.datas_pb2.Data()
+    encoded = xbuf_export.export(scene, data, cfg)
+    (refs, relations) = deleteData(writer, cfg)
+    entries = data_entries(data, encoded)
+    if sent is not None:
+        sent.forget(refs, relations)
+    # the coarser levels of detail first, the receiver can draw them while it receives the detailed meshes
+    for part in split_detailed(entries, cfg.detailed_meshes):
+        if sent is None:
+            kept = [(field, raw) for _, field, raw in part]
+        else:
+            suppressed = sent.suppressed_bytes
+            kept = sent.filter(part)
+            cfg.info("setData: %d / %d entries sent, %d bytes suppressed (total sent %d bytes, suppressed %d bytes)" % (len(kept), len(part), sent.suppressed_bytes - suppressed, sent.sent_bytes, sent.suppressed_bytes))
+        if len(kept) > 0:
+            # print("send setData")
+            # the entities (and encoded meshes) are appended to the serialized setData (without parsing them)
+            raw = mesh_encoding.serialize_with(xbuf.datas_pb2.Data(), kept)
+            writeMessage(writer, Kind.xbuf_cmd, mesh_encoding.serialize_with(xbuf.cmds_pb2.Cmd(), [("setData", raw)]))
+
+
+def split_detailed(entries, detailed):
+    """
+    return [entries] or [entries without the detailed meshes, entries of the detailed meshes and of their relations]
+    (detailed: ids of the meshes with coarser levels of detail, see ExportCfg.detailed_meshes)
+    """
+    if len(detailed) == 0:
+        return [entries]
+    parts = ([], [])
+    for entry in entries:
+        key = entry[0]
+        is_detailed = (key[0] == "meshes" and key[1] in detailed) or (key[0] == "relations" and (key[1] in detailed or key[2] in detailed))
+        parts[is_detailed].append(entry)
+    return [part for part in parts if len(part) > 0]
+
+
+def deleteData(writer, cfg):
+    """
+    send the entities and relations deleted since the last call (see ExportCfg.end_sync), in one command,
+    return ([refs], [(ref1, ref2)]) sent
+    """
+    (refs, relations) = cfg.pop_deleted()
+    if len(refs) > 0 or len(relations) > 0:
+        cmd = xbuf.cmds_pb2.Cmd()
+        cmd.deleteData.refs.extend(refs)
+        for ref1, ref2 in relations:
+            rel = cmd.deleteData.relations.add()
+            rel.ref1 = ref1
+            rel.ref2 = ref2
         writeMessage(writer, Kind.xbuf_cmd, cmd.SerializeToString())
+    return (refs, relations)
 
 
 def changeAssetFolders(writer, cfg):
@@ -18,6 +18,7 @@ import bpy
 import bgl
 import asyncio
 import time
+import numpy
 from . import protocol     # pylint: disable=W0406
 from . import helpers      # pylint: disable=W0406
 from . import xbuf_export  # pylint: disable=W0406
@@ -30,11 +31,27 @@ from . import xbuf_export  # pylint: disable=W0406
 
 
 class SceneChangeListener:
+    """
+    record the datablocks updated by blender (is_updated flags) into ctx (see ExportCfg.need_update).
+    The flags are read with one foreach_get per collection (and only for the types tagged as updated),
+    and the updates of a burst (eg while scrubbing) are coalesced and applied at most every `window`
+    seconds (and before every export, see flush).
+    """
 
-    def __init__(self, ctx, screen):
+    def __init__(self, ctx, screen, window=0.05):
         self.ctx = ctx
         self.first = True
         self.screen = screen
+        self.window = window
+        # names of the updated objects, objects with updated data, materials not yet applied to ctx
+        self.pending_objects = set()
+        self.pending_datas = set()
+        self.pending_materials = set()
+        self.last_flush = time.perf_counter()
+        # time spent into scene_update_post since the last flush
+        self.ticks = 0
+        self.ticks_duration = 0.0
+        self.ticks_max_duration = 0.0
 
     def register(self):
         # print("register SceneChangeListener")
@@ -49,17 +66,76 @@ class SceneChangeListener:
         if self.screen.is_animation_playing:
             return
         # print("scene_update_post")
-        for obj in scene.objects:
-            if obj.is_updated or self.first:
+        start = time.perf_counter()
+        if self.first:
+            for obj in scene.objects:
                 self.ctx.need_update(obj, True)
-            if (obj.data is not None) and (obj.is_updated_data or self.first):
+                if obj.data is not None:
+                    self.ctx.need_update(obj.data, True)
+                if obj.type == 'MESH':
+                    for slot in obj.material_slots:
+                        if slot.material is not None:
+                            self.ctx.need_update(slot.material, True)
+            self.first = False
+        else:
+            self.collect(scene)
+        if start - self.last_flush >= self.window:
+            self.flush(scene)
+        duration = time.perf_counter() - start
+        self.ticks += 1
+        self.ticks_duration += duration
+        self.ticks_max_duration = max(self.ticks_max_duration, duration)
+
+    def collect(self, scene):
+        """
+        add the names of the datablocks flagged as updated (by the last depsgraph update) to the pending ones.
+        It can't wait for the flush: blender clears the is_updated flags after every scene_update_post.
+        Its cost is a check of the flags of the collections, and for the ticks with updated objects two
+        foreach_get of len(scene.objects) ints (in C, no python loop over the objects), see report_ticks.
+        """
+        data = bpy.data
+        if data.objects.is_updated or data.meshes.is_updated or data.lamps.is_updated or data.armatures.is_updated:
+            objects = scene.objects
+            # foreach_get reads booleans as ints (blender 2.7x has no raw type for booleans), a buffer of
+            # another type makes it read item by item
+            updated = xbuf_export.foreach_array(objects, "is_updated", 1, numpy.int32)[:, 0]
+            updated_data = xbuf_export.foreach_array(objects, "is_updated_data", 1, numpy.int32)[:, 0]
+            for i in numpy.flatnonzero(updated):
+                self.pending_objects.add(objects[i].name)
+            for i in numpy.flatnonzero(updated_data):
+                self.pending_datas.add(objects[i].name)
+        if data.materials.is_updated:
+            materials = data.materials
+            updated = xbuf_export.foreach_array(materials, "is_updated", 1, numpy.int32)[:, 0]
+            for i in numpy.flatnonzero(updated):
+                self.pending_materials.add(materials[i].name)
+
+    def flush(self, scene):
+        """apply the pending updates to ctx (datablocks removed since are ignored)"""
+        for name in self.pending_objects:
+            obj = scene.objects.get(name)
+            if obj is not None:
+                self.ctx.need_update(obj, True)
+        for name in self.pending_datas:
+            obj = scene.objects.get(name)
+            if obj is not None and obj.data is not None:
                 self.ctx.need_update(obj.data, True)
-            if obj.type == 'MESH':
-                for i in range(len(obj.material_slots)):
-                    src_mat = obj.material_slots[i].material
-                    if (src_mat is not None) and (src_mat.is_updated or self.first):
-                        self.ctx.need_update(src_mat, True)
-        self.first = False
+        for name in self.pending_materials:
+            mat = bpy.data.materials.get(name)
+            if mat is not None:
+                self.ctx.need_update(mat, True)
+        self.pending_objects.clear()
+        self.pending_datas.clear()
+        self.pending_materials.clear()
+        self.last_flush = time.perf_counter()
+
+    def report_ticks(self):
+        """log the time spent into scene_update_post since the last report"""
+        if self.ticks > 0:
+            self.ctx.info("scene_update_post: %d ticks, %.3fms avg, %.3fms max" % (self.ticks, self.ticks_duration * 1000.0 / self.ticks, self.ticks_max_duration * 1000.0))
+        self.ticks = 0
+        self.ticks_duration = 0.0
+        self.ticks_max_duration = 0.0
 
 
 class ExternalRenderEngine(bpy.types.RenderEngine):
@@ -80,16 +156,23 @@ class ExternalRenderEngine(bpy.types.RenderEngine):
         self.client = protocol.Client()
         self.sceneChangeListener = None
         self.last_selected_strips = {}
+        self.assets_progress = None
 
     def __del__(self):
         print("__del__")
         if hasattr(self, 'client'):
-            if self.client is not None:
-                self.client.close()
-                self.client = None
+            self.close_client()
         if hasattr(self, 'client') and self.sceneChangeListener is not None:
             self.sceneChangeListener.unregister()
 
+    def close_client(self):
+        """close the connection, and the workers (processes, threads) of the export (restarted by the next export)"""
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        if self.sceneChangeListener is not None:
+            self.sceneChangeListener.ctx.close()
+
     def external_render(self, context_or_camera, width, height, flocal):
         (loc, rot, projection, near, far, is_ortho) = helpers.extractEye(context_or_camera)
 
@@ -112,8 +195,7 @@ class ExternalRenderEngine(bpy.types.RenderEngine):
                         self.tag_redraw()
             except BrokenPipeError:
                 self.report({'WARNING'}, "failed to connect to remote host (%r:%r)" % (self.host, self.port))
-                self.client.close()
-                self.client = None
+                self.close_client()
         if self.client is not None:
             protocol.run_until_complete(my_render())
 
@@ -149,8 +231,7 @@ class ExternalRenderEngine(bpy.types.RenderEngine):
                 yield from self.client.connect(self.host, self.port)
                 protocol.playAnimation(self.client.writer, objid, selected_strips)
             except BrokenPipeError:
-                self.client.close()
-                self.client = None
+                self.close_client()
         if self.client is not None:
             protocol.run_until_complete(my_cmd)
 
@@ -171,10 +252,12 @@ class ExternalRenderEngine(bpy.types.RenderEngine):
         self.port = scene.external_render.port
         self.auto_redraw = scene.external_render.auto_redraw
         if self.sceneChangeListener is None:
-            cfg0 = xbuf_export.ExportCfg(is_preview=False, assets_path=scene.xbuf.assets_path)
+            cfg0 = xbuf_export.ExportCfg(is_preview=False, assets_path=scene.xbuf.assets_path, skin_max_influences=scene.xbuf.skin_max_influences if scene.xbuf.skin_fixed_stride else 0, quantize_vertices=scene.external_render.quantize_vertices, mesh_patches=scene.external_render.mesh_patches, lod_count=scene.xbuf.lod_count, lod_ratio=scene.xbuf.lod_ratio, encode_workers=scene.xbuf.encode_workers, max_vertices=scene.xbuf.max_vertices, vertex_cache_size=scene.xbuf.vertex_cache_size, triangle_strips=scene.xbuf.triangle_strips, texture_workers=scene.xbuf.texture_workers, texture_strategy=scene.xbuf.texture_strategy)
             self.sceneChangeListener = SceneChangeListener(cfg0, context.screen)
             self.sceneChangeListener.register()
             self.sceneChangeListener.scene_update_post(scene)
+        self.sceneChangeListener.flush(scene)
+        self.sceneChangeListener.report_ticks()
         cfg = self.sceneChangeListener.ctx
 
         @asyncio.coroutine
@@ -183,11 +266,10 @@ class ExternalRenderEngine(bpy.types.RenderEngine):
                 yield from self.client.connect(self.host, self.port)
                 # TODO avoid to request changeAssetFolders if same as before
                 protocol.changeAssetFolders(self.client.writer, cfg)
-                protocol.setData(self.client.writer, scene, cfg)
+                protocol.setData(self.client.writer, scene, cfg, self.client.sent)
             except BrokenPipeError:
                 self.report({'WARNING'}, "failed to connect to remote host (%r:%r)" % (self.host, self.port))
-                self.client.close()
-                self.client = None
+                self.close_client()
         if self.client is not None:
             protocol.run_until_complete(my_update())
         # else:
@@ -221,8 +303,19 @@ class ExternalRenderEngine(bpy.types.RenderEngine):
         height = int(region.height)
         self.external_render(context, width, height, self.view_draw_image)
         self.check_strip_selection(context.scene)
+        self.report_assets_progress()
         #print("time view_draw %r" % (time.process_time() - start))
 
+    def report_assets_progress(self):
+        """show the progress of the textures written into the assets folder (in background)"""
+        if self.sceneChangeListener is None:
+            return
+        (done, total) = self.sceneChangeListener.ctx.assets.progress()
+        progress = (done, total) if done < total else None
+        if progress != self.assets_progress:
+            self.assets_progress = progress
+            self.update_stats("", "" if progress is None else "xbuf textures: %d/%d" % progress)
+
     def render_image(self, width, height, raw):
         # TODO optimize the loading/convertion of raw (other renderengine use load_from_file instead of rect)
         # do benchmark array vs list
@@ -0,0 +1,48 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# tests of the modules without bpy (mesh_utils, mesh_encoding,...), run outside of blender with:
+#   python -m pytest tests
+# the addon folder is registered as the package blender_io_xbuf, without running its __init__ (it needs bpy)
+
+import os
+import sys
+import types
+import asyncio
+import collections
+import collections.abc
+
+ADDON_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Python dependencies are bundled inside the modules folder (like in __init__)
+_modules_path = os.path.join(ADDON_PATH, "modules")
+if _modules_path not in sys.path:
+    sys.path.append(_modules_path)
+
+# the bundled protobuf uses the aliases removed from collections in python 3.10
+for _name in ("Mapping", "MutableMapping", "Sequence", "MutableSequence", "MutableSet", "Iterable", "Callable"):
+    if not hasattr(collections, _name):
+        setattr(collections, _name, getattr(collections.abc, _name))
+
+# protocol is written for the generators coroutines of python 3.5 (blender 2.7x), removed in python 3.11
+if not hasattr(asyncio, "coroutine"):
+    asyncio.coroutine = types.coroutine
+
+if "blender_io_xbuf" not in sys.modules:
+    _package = types.ModuleType("blender_io_xbuf")
+    _package.__path__ = [ADDON_PATH]
+    sys.modules["blender_io_xbuf"] = _package
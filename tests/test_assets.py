@@ -0,0 +1,92 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# writes into the assets folder (manifest, writer)
+
+import os
+import pytest
+
+from blender_io_xbuf import assets
+
+
+def make_writer(tmpdir, workers, warnings):
+    return assets.AssetsWriter(assets.AssetsManifest(str(tmpdir.join("assets"))), workers, lambda txt: None, warnings.append)
+
+
+def test_copy_file_missing_source(tmpdir):
+    manifest = assets.AssetsManifest(str(tmpdir))
+    with pytest.raises(FileNotFoundError):
+        manifest.copy_file(str(tmpdir.join("missing.png")), "textures/missing.png")
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_writer_missing_source(tmpdir, workers):
+    warnings = []
+    writer = make_writer(tmpdir, workers, warnings)
+    writer.copy_file(str(tmpdir.join("missing.png")), "textures/missing.png")
+    writer.close()
+    assert writer.progress() == (0, 0)
+    assert len(warnings) == 1
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_writer_saves_manifest_once_per_batch(tmpdir, workers):
+    writer = make_writer(tmpdir, workers, [])
+    saves = []
+    save = writer.manifest.save
+    writer.manifest.save = lambda: (saves.append(writer.manifest._modified), save())
+    for i in range(10):
+        writer.write_bytes(b"texture %d" % i, "textures/%d.png" % i)
+    writer.end_batch()
+    writer.close()
+    # the save of close finds nothing modified
+    assert saves == [True, False]
+    assert os.path.isfile(writer.manifest.path)
+    assert len(assets.AssetsManifest(writer.manifest.assets_path).entries()) == 10
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_writer_retries_failed_write(tmpdir, workers):
+    warnings = []
+    writer = make_writer(tmpdir, workers, warnings)
+    # a file where the folder should be
+    tmpdir.join("assets").write("")
+    writer.write_bytes(b"texture", "textures/a.png")
+    writer.end_batch()
+    writer.close()
+    assert len(warnings) == 1
+    assert writer.progress() == (0, 0)
+    tmpdir.join("assets").remove()
+    assert writer.retry_failed() == 1
+    writer.close()
+    assert tmpdir.join("assets", "textures", "a.png").read_binary() == b"texture"
+    assert writer.retry_failed() == 0
+
+
+def test_writer_retry_superseded(tmpdir):
+    writer = make_writer(tmpdir, 2, [])
+    tmpdir.join("assets").write("")
+    writer.write_bytes(b"old", "textures/a.png")
+    writer.close()
+    tmpdir.join("assets").remove()
+    # the retry and the new version wait for the same file, in any order the new version must be kept
+    with writer._rpath_locks["textures/a.png"]:
+        writer.retry_failed()
+        writer.write_bytes(b"new", "textures/a.png")
+    writer.close()
+    assert tmpdir.join("assets", "textures", "a.png").read_binary() == b"new"
+    assert writer.retry_failed() == 0
@@ -0,0 +1,48 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# levels of detail decimated by the encoder (see mesh_encoding.MeshPayload.lod_triangles)
+
+import numpy
+import xbuf
+import xbuf.datas_pb2
+
+from blender_io_xbuf import mesh_encoding
+from test_mesh_utils import height_field
+from test_morphs import decode_mesh
+
+POSITION = xbuf.datas_pb2.VertexArray.position
+
+
+def test_lod_decimated_by_encoder():
+    (arrays, positions) = height_field(16)
+    # 2 influences per blender vertex (fixed stride), a bone by row of the grid
+    rows = positions[:, 1].astype(numpy.int64)
+    skin = (numpy.full(len(positions), 2), numpy.column_stack((rows, rows + 100)), numpy.tile([[0.75, 0.25]], (len(positions), 1)))
+    payload = mesh_encoding.MeshPayload("m_lod1", "m_lod1", 1, arrays, skin, False, vertex_cache_size=8, lod_triangles=128)
+    (encoded, infos, kept) = mesh_encoding.encode_mesh(payload)
+    assert kept is None
+    assert any(txt.startswith("lod 1 of 'm_lod1': 512 -> ") for txt in infos), infos
+    mesh = xbuf.datas_pb2.Mesh()
+    mesh.ParseFromString(dict(encoded)["meshes"])
+    assert mesh.lod == 1
+    (decoded, triangles, _) = decode_mesh(dict(encoded)["meshes"])
+    assert 0 < len(triangles) <= 128
+    # every vertex has the skin of its blender vertex (found by position)
+    bone_index = numpy.array(mesh.skin.boneIndex).reshape((-1, 2))
+    numpy.testing.assert_array_equal(bone_index[:, 0], decoded[:, 1].astype(numpy.int64))
+    numpy.testing.assert_array_equal(bone_index[:, 1], bone_index[:, 0] + 100)
@@ -0,0 +1,126 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# patches of the vertices of meshes (see mesh_encoding.MeshPatcher)
+
+import numpy
+import pytest
+import xbuf
+import xbuf.datas_pb2
+
+from blender_io_xbuf import mesh_encoding
+from blender_io_xbuf import mesh_utils
+
+POSITION = xbuf.datas_pb2.VertexArray.position
+TEXCOORD = xbuf.datas_pb2.VertexArray.texcoord
+SIZE = 60
+
+
+def grid_payload(positions, triangles=None, vertex_cache_size=16):
+    (y, x) = numpy.mgrid[0:SIZE, 0:SIZE]
+    if triangles is None:
+        q = numpy.arange(SIZE * SIZE).reshape((SIZE, SIZE))
+        (a, b, c, d) = (q[:-1, :-1].ravel(), q[:-1, 1:].ravel(), q[1:, 1:].ravel(), q[1:, :-1].ravel())
+        triangles = numpy.concatenate((numpy.column_stack((a, b, c)), numpy.column_stack((a, c, d))))
+    uvs = (numpy.column_stack((x.ravel(), y.ravel())) / SIZE).astype(numpy.float32)
+    arrays = mesh_utils.MeshArrays(numpy.arange(SIZE * SIZE), [(POSITION, positions), (TEXCOORD, uvs)], triangles)
+    return mesh_encoding.MeshPayload("m", "m", 0, arrays, None, False, vertex_cache_size=vertex_cache_size)
+
+
+def grid_positions():
+    (y, x) = numpy.mgrid[0:SIZE, 0:SIZE]
+    return numpy.column_stack((x.ravel(), y.ravel(), numpy.zeros(x.size))).astype(numpy.float32)
+
+
+def decode(encoded):
+    """return ({attrib: values}, {attrib: indices or None}) of the encoded xbuf.Mesh"""
+    mesh = xbuf.datas_pb2.Mesh()
+    mesh.ParseFromString(dict(encoded)["meshes"])
+    values = dict((array.attrib, numpy.array(array.floats.values, dtype=numpy.float32).reshape((-1, array.floats.step))) for array in mesh.vertexArrays)
+    indices = [array.ints.values for array in mesh.indexArrays]
+    return (values, indices, mesh)
+
+
+def send(patcher, payload):
+    (encoded, _, kept) = mesh_encoding.encode_mesh(payload)
+    patcher.sent(payload, kept)
+    return encoded
+
+
+@pytest.mark.parametrize("vertex_cache_size", [0, 16])
+def test_patch_equals_full_encoding(vertex_cache_size):
+    patcher = mesh_encoding.MeshPatcher()
+    positions = grid_positions()
+    (arrays, _, _) = decode(send(patcher, grid_payload(positions, vertex_cache_size=vertex_cache_size)))
+    moved = numpy.random.RandomState(1).choice(len(positions), 10, replace=False)
+    positions = positions.copy()
+    positions[moved, 2] += 1.5
+    patch = patcher.patch(grid_payload(positions, vertex_cache_size=vertex_cache_size))
+    assert patch is not None
+    (values, indices, mesh) = decode(patch)
+    # only the changed attribute, indices are ints
+    assert [array.attrib for array in mesh.vertexArrays] == [POSITION]
+    assert mesh.indexArrays[0].ints.step == 1
+    assert len(indices[0]) <= len(moved) * mesh_encoding.PATCH_BLOCK
+    arrays[POSITION][numpy.array(indices[0])] = values[POSITION]
+    (expected, _, _) = decode(mesh_encoding.encode_mesh(grid_payload(positions, vertex_cache_size=vertex_cache_size))[0])
+    numpy.testing.assert_array_equal(arrays[POSITION], expected[POSITION])
+    numpy.testing.assert_array_equal(arrays[TEXCOORD], expected[TEXCOORD])
+
+
+def test_patch_without_change():
+    patcher = mesh_encoding.MeshPatcher()
+    send(patcher, grid_payload(grid_positions()))
+    (values, indices, _) = decode(patcher.patch(grid_payload(grid_positions())))
+    assert values == {} and indices == []
+
+
+def test_patch_fallback_to_full_mesh():
+    patcher = mesh_encoding.MeshPatcher()
+    positions = grid_positions()
+    assert patcher.patch(grid_payload(positions)) is None
+    send(patcher, grid_payload(positions))
+    # most of the vertices changed
+    assert patcher.patch(grid_payload(positions + 0.5)) is None
+    # other topology
+    triangles = grid_payload(positions).arrays.triangles.copy()
+    triangles[0] = triangles[0][::-1]
+    assert patcher.patch(grid_payload(positions, triangles)) is None
+
+
+def test_patcher_state_is_compact():
+    for vertex_cache_size in (0, 16):
+        patcher = mesh_encoding.MeshPatcher()
+        payload = grid_payload(grid_positions(), vertex_cache_size=vertex_cache_size)
+        send(patcher, payload)
+        (_, digests, order) = patcher._states["m"]
+        assert (order is None) == (vertex_cache_size == 0)
+        state_size = sum(digest.nbytes for _, _, digest in digests) + (0 if order is None else order.nbytes)
+        arrays_size = sum(values.nbytes for _, values in payload.arrays.vertex_arrays)
+        # the order of the encoded vertices (4 bytes per vertex) is the largest part, when reordered
+        assert state_size * (16 if order is None else 3) < arrays_size
+
+
+def test_block_digests():
+    rand = numpy.random.RandomState(2)
+    values = rand.randn(100, 3).astype(numpy.float32)
+    digests = mesh_utils.block_digests(values, 16)
+    assert len(digests) == 7 and len(numpy.unique(digests)) == 7
+    changed = values.copy()
+    changed[40, 1] = numpy.nextafter(changed[40, 1], numpy.float32(1))
+    changed[99, 0] += 1.0
+    assert numpy.flatnonzero(mesh_utils.block_digests(changed, 16) != digests).tolist() == [2, 6]
@@ -0,0 +1,254 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# processing of the mesh arrays (see mesh_utils)
+
+import numpy
+import xbuf
+import xbuf.datas_pb2
+
+from blender_io_xbuf import mesh_utils
+
+POSITION = xbuf.datas_pb2.VertexArray.position
+NORMAL = xbuf.datas_pb2.VertexArray.normal
+TEXCOORD = xbuf.datas_pb2.VertexArray.texcoord
+
+
+def corners_of(arrays):
+    """return the values of every corner of the triangles (shape (m, 3, sum of steps)), with the blender vertex"""
+    columns = [arrays.vertex[:, numpy.newaxis].astype(numpy.float64)] + [values for _, values in arrays.vertex_arrays]
+    return numpy.hstack(columns)[arrays.triangles]
+
+
+def two_quads():
+    """
+    2 quads (4 triangles, 12 corners) sharing the blender vertices 1 and 2, with a flat normal per quad
+    (split normals at the shared edge), and a uv seam on the shared edge
+    """
+    vertex = numpy.array([0, 1, 2, 0, 2, 3, 1, 4, 5, 1, 5, 2])
+    normals = numpy.repeat(numpy.array([[0, 0, 1], [0, 0, 1], [0, 1, 0], [0, 1, 0]], dtype=numpy.float32), 3, axis=0)
+    uvs = numpy.array([[0, 0], [1, 0], [1, 1], [0, 0], [1, 1], [0, 1], [0, 0], [1, 0], [1, 1], [0, 0], [1, 1], [0, 1]], dtype=numpy.float32)
+    triangles = numpy.arange(12).reshape((-1, 3))
+    return mesh_utils.MeshArrays(vertex, [(NORMAL, normals), (TEXCOORD, uvs)], triangles)
+
+
+def test_weld_merges_identical_corners():
+    arrays = two_quads()
+    welded = mesh_utils.weld(arrays)
+    # first quad: (0, n0, uv00) twice, (2, n0, uv11) twice; second quad: (1, n1, uv00) twice, (5, n1, uv11) twice
+    assert welded.vertices_count() == 8
+    numpy.testing.assert_array_equal(corners_of(welded), corners_of(arrays))
+
+
+def test_weld_keeps_split_normals_and_uv_seams():
+    arrays = two_quads()
+    welded = mesh_utils.weld(arrays)
+    # the blender vertices of the shared edge have a vertex per side (other normal, other uv)
+    for v in (1, 2):
+        keys = set(tuple(row) for row in numpy.hstack([values for _, values in welded.vertex_arrays])[welded.vertex == v].tolist())
+        assert len(keys) == 2
+    # same normals and uvs on both sides: the seam still splits the vertices with other uvs
+    (normals, uvs) = (arrays.vertex_arrays[0][1].copy(), arrays.vertex_arrays[1][1])
+    normals[:] = (0, 0, 1)
+    smooth = mesh_utils.weld(mesh_utils.MeshArrays(arrays.vertex, [(NORMAL, normals), (TEXCOORD, uvs)], arrays.triangles))
+    assert smooth.vertices_count() == 8
+    without_seam = mesh_utils.weld(mesh_utils.MeshArrays(arrays.vertex, [(NORMAL, normals)], arrays.triangles))
+    assert without_seam.vertices_count() == 6
+
+
+def test_weld_empty():
+    arrays = mesh_utils.MeshArrays(numpy.zeros(0, dtype=numpy.int64), [(NORMAL, numpy.zeros((0, 3), dtype=numpy.float32))], numpy.zeros((0, 3), dtype=numpy.int64))
+    assert mesh_utils.weld(arrays).vertices_count() == 0
+
+
+def test_limit_influences():
+    # vertex 0: 6 influences, vertex 1: 2 influences, vertex 2: none
+    vertex = numpy.array([0, 0, 0, 0, 0, 0, 1, 1])
+    group = numpy.array([0, 1, 2, 3, 4, 5, 1, 2])
+    weight = numpy.array([0.05, 0.4, 0.1, 0.2, 0.15, 0.1, 0.5, 1.5])
+    influences = mesh_utils.VertexInfluences.from_groups(3, vertex, group, weight, numpy.array([10, 11, 12, 13, 14, 15]))
+    (bone_index, bone_weight, error) = influences.limit(4)
+    assert bone_index.shape == (3, 4) and bone_weight.shape == (3, 4)
+    # the 4 strongest, by decreasing weight, renormalized
+    assert bone_index[0].tolist() == [11, 13, 14, 12]
+    numpy.testing.assert_allclose(bone_weight[0], numpy.array([0.4, 0.2, 0.15, 0.1]) / 0.85)
+    numpy.testing.assert_allclose(numpy.sum(bone_weight[:2], axis=1), 1.0)
+    # padded with (0, 0.0)
+    assert bone_index[1].tolist() == [12, 11, 0, 0]
+    numpy.testing.assert_allclose(bone_weight[1], [0.75, 0.25, 0.0, 0.0])
+    assert bone_weight[2].tolist() == [0.0, 0.0, 0.0, 0.0]
+    # error: the change of the kept weights (0.4 -> 0.4 / 0.85) or the strongest dropped (0.1)
+    numpy.testing.assert_allclose(error, [max(0.4 / 0.85 - 0.4, 0.1), 0.0, 0.0])
+
+
+def test_limit_influences_keeps_all_under_max():
+    influences = mesh_utils.VertexInfluences.from_groups(2, numpy.array([0, 0, 1]), numpy.array([0, 1, 0]), numpy.array([0.25, 0.75, 1.0]), numpy.array([3, 4]))
+    (bone_index, bone_weight, error) = influences.limit(4)
+    assert bone_index[:, :2].tolist() == [[4, 3], [3, 0]]
+    numpy.testing.assert_allclose(bone_weight[:, :2], [[0.75, 0.25], [1.0, 0.0]])
+    numpy.testing.assert_allclose(error, 0.0, atol=1e-12)
+
+
+def test_quantize_unorm_positions():
+    rand = numpy.random.RandomState(3)
+    positions = (rand.rand(1000, 3) * [100.0, 2.0, 0.001] - [50.0, 1.0, 0.0]).astype(numpy.float32)
+    (offset, scale, quantized) = mesh_utils.quantize_unorm(positions, 16)
+    assert quantized.shape == positions.shape and quantized.max() <= 65535
+    error = numpy.abs(mesh_utils.dequantize_unorm(offset, scale, quantized) - positions)
+    # half a step per component (+ float32 rounding)
+    assert numpy.all(error <= scale * 0.5 + 1e-6 * numpy.abs(positions).max(axis=0))
+    # the bounds are exact
+    numpy.testing.assert_array_equal(quantized.min(axis=0), 0)
+    numpy.testing.assert_array_equal(quantized.max(axis=0), 65535)
+
+
+def test_quantize_unorm_uvs():
+    rand = numpy.random.RandomState(4)
+    uvs = rand.rand(1000, 2).astype(numpy.float32)
+    uvs[:, 1] = 0.25
+    (offset, scale, quantized) = mesh_utils.quantize_unorm(uvs, 16)
+    decoded = mesh_utils.dequantize_unorm(offset, scale, quantized)
+    assert numpy.abs(decoded[:, 0] - uvs[:, 0]).max() <= 0.5 / 65535 + 1e-7
+    # a constant component (scale 0) is exact
+    assert scale[1] == 0 and numpy.all(decoded[:, 1] == uvs[:, 1])
+
+
+def quat_error(expected, actual):
+    """max difference per quaternion, q and -q are the same rotation"""
+    return numpy.minimum(numpy.abs(expected - actual).max(axis=1), numpy.abs(expected + actual).max(axis=1))
+
+
+def test_quantize_quat_smallest_three():
+    rand = numpy.random.RandomState(5)
+    quats = rand.randn(2000, 4)
+    quats /= numpy.linalg.norm(quats, axis=1)[:, numpy.newaxis]
+    packed = mesh_utils.quantize_quat_smallest_three(quats, 10)
+    assert packed.dtype == numpy.uint32
+    decoded = mesh_utils.dequantize_quat_smallest_three(packed, 10)
+    # half a step of the 3 others (range sqrt(2) over 1023 steps), the largest is rebuilt from them
+    assert quat_error(quats, decoded).max() < 2e-3
+    numpy.testing.assert_allclose(numpy.linalg.norm(decoded, axis=1), 1.0, atol=2e-3)
+
+
+def test_quantize_quat_smallest_three_sign_and_largest():
+    s = numpy.sqrt(0.5)
+    quats = numpy.array([
+        [1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1],
+        [0, 0, 0, -1], [-1, 0, 0, 0],
+        [0.5, 0.5, 0.5, 0.5], [-0.5, 0.5, -0.5, 0.5],
+        [s, s, 0, 0], [-s, s, 0, 0], [0, 0, s, -s],
+    ])
+    packed = mesh_utils.quantize_quat_smallest_three(quats, 10)
+    # the index of the largest component (the first one on ties)
+    assert (packed >> 30).tolist() == [0, 1, 2, 3, 3, 0, 0, 0, 0, 0, 2]
+    # q and -q are packed the same
+    numpy.testing.assert_array_equal(packed, mesh_utils.quantize_quat_smallest_three(-quats, 10))
+    decoded = mesh_utils.dequantize_quat_smallest_three(packed, 10)
+    assert quat_error(quats, decoded).max() < 2e-3
+    # the largest component is rebuilt positive
+    assert numpy.all(decoded[numpy.arange(len(quats)), packed >> 30] > 0)
+
+
+def height_field(size, seed=6):
+    """return MeshArrays of a bumpy grid of size x size quads (z up), with the positions of its vertices"""
+    (x, y) = numpy.meshgrid(numpy.arange(size + 1, dtype=numpy.float32), numpy.arange(size + 1, dtype=numpy.float32))
+    z = numpy.sin(x * 0.3) * numpy.cos(y * 0.2) + numpy.random.RandomState(seed).rand(*x.shape) * 0.05
+    positions = numpy.column_stack((x.ravel(), y.ravel(), z.ravel())).astype(numpy.float32)
+    quads = numpy.arange((size + 1) * size).reshape((size, size + 1))[:, :-1].ravel()
+    corners = numpy.column_stack((quads, quads + 1, quads + size + 2, quads + size + 1))
+    triangles = corners[:, [0, 1, 2, 0, 2, 3]].reshape((-1, 3))
+    return (mesh_utils.MeshArrays(numpy.arange(len(positions)), [(POSITION, positions)], triangles), positions)
+
+
+def test_decimate_triangles_count():
+    (arrays, positions) = height_field(24)
+    for target in (800, 300, 100):
+        decimated = mesh_utils.decimate(arrays, positions, target)
+        assert target * 0.9 <= len(decimated.triangles) <= target
+        # vertices keep their values
+        numpy.testing.assert_array_equal(dict(decimated.vertex_arrays)[POSITION], positions[decimated.vertex])
+
+
+def test_decimate_keeps_borders():
+    (arrays, positions) = height_field(24)
+    decimated = mesh_utils.decimate(arrays, positions, 100)
+    border = numpy.flatnonzero(numpy.any((positions[:, :2] == 0) | (positions[:, :2] == 24), axis=1))
+    locked = mesh_utils.locked_vertices(positions, arrays.triangles)
+    numpy.testing.assert_array_equal(numpy.flatnonzero(locked), border)
+    assert set(border.tolist()) <= set(decimated.vertex.tolist())
+
+
+def test_locked_vertices_on_seams():
+    (arrays, positions) = height_field(8)
+    # a uv seam: the triangles right of x = 4 use copies of the vertices at x = 4
+    seam = numpy.flatnonzero(positions[:, 0] == 4)
+    triangles = arrays.triangles.copy()
+    right = (positions[triangles][:, :, 0].max(axis=1) > 4)[:, numpy.newaxis] & numpy.isin(triangles, seam)
+    triangles[right] = len(positions) + numpy.searchsorted(seam, triangles[right])
+    positions = numpy.concatenate((positions, positions[seam]))
+    locked = mesh_utils.locked_vertices(positions, triangles)
+    inside = numpy.all((positions[:, :2] > 0) & (positions[:, :2] < 8), axis=1)
+    numpy.testing.assert_array_equal(locked[inside], positions[inside, 0] == 4)
+
+
+def test_decimate_no_flipped_normals():
+    (arrays, positions) = height_field(24)
+    assert numpy.all(mesh_utils.triangle_normals(positions, arrays.triangles)[:, 2] > 0)
+    for target in (400, 100, 20):
+        decimated = mesh_utils.decimate(arrays, positions, target)
+        normals = mesh_utils.triangle_normals(dict(decimated.vertex_arrays)[POSITION], decimated.triangles)
+        assert numpy.all(normals[:, 2] > 0)
+
+
+def test_split_chunks_under_budget():
+    (arrays, positions) = height_field(20)
+    rand = numpy.random.RandomState(7)
+    arrays = mesh_utils.MeshArrays(arrays.vertex, arrays.vertex_arrays, arrays.triangles[rand.permutation(len(arrays.triangles))])
+    for max_vertices in (3, 50, 200):
+        chunks = mesh_utils.split(arrays, max_vertices)
+        assert len(chunks) > 1
+        for chunk in chunks:
+            assert chunk.vertices_count() <= max_vertices
+            assert chunk.triangles.max() < max_vertices
+        # the chunks are the triangles of the mesh, in order
+        reassembled = numpy.concatenate([chunk.vertex[chunk.triangles] for chunk in chunks])
+        numpy.testing.assert_array_equal(reassembled, arrays.vertex[arrays.triangles])
+        for chunk in chunks:
+            numpy.testing.assert_array_equal(dict(chunk.vertex_arrays)[POSITION], positions[chunk.vertex])
+    assert mesh_utils.split(arrays, arrays.vertices_count()) == [arrays]
+
+
+def fifo_misses(triangles, cache_size):
+    """reference: the misses of a fifo cache of cache_size (vertices)"""
+    cache = []
+    misses = 0
+    for v in triangles.ravel().tolist():
+        if v not in cache:
+            misses += 1
+            cache = (cache + [v])[-cache_size:]
+    return misses
+
+
+def test_acmr_of_fifo_cache():
+    (arrays, _) = height_field(12)
+    triangles = arrays.triangles[numpy.random.RandomState(8).permutation(len(arrays.triangles))]
+    for cache_size in (4, 16):
+        before = mesh_utils.acmr(triangles, cache_size)
+        assert before == fifo_misses(triangles, cache_size) / len(triangles)
+        (order, misses) = mesh_utils.tipsify(triangles, arrays.vertices_count(), cache_size)
+        assert misses == fifo_misses(triangles[order], cache_size)
+        assert mesh_utils.acmr(triangles[order], cache_size) < before
@@ -0,0 +1,130 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# sparse morphs (see mesh_encoding.export_morphs): size, and decoding after the reorder of vertices and strips
+
+import numpy
+import xbuf
+import xbuf.datas_pb2
+
+from blender_io_xbuf import mesh_encoding
+from blender_io_xbuf import mesh_utils
+
+POSITION = xbuf.datas_pb2.VertexArray.position
+
+
+def grid(size):
+    """
+    return (blender vertex of every vertex, positions of the blender vertices, triangles) of a grid of size x size quads,
+    the vertices of the middle column are split (like a seam of uvs), so some blender vertices have 2 vertices
+    """
+    (x, y) = numpy.meshgrid(numpy.arange(size + 1), numpy.arange(size + 1))
+    positions = numpy.column_stack((x.ravel(), y.ravel(), numpy.zeros(x.size))).astype(numpy.float32)
+    quads = numpy.arange((size + 1) * size).reshape((size, size + 1))[:, :-1].ravel()
+    corners = numpy.column_stack((quads, quads + 1, quads + size + 2, quads + size + 1))
+    seam = numpy.flatnonzero(x.ravel() == size // 2)
+    right = (quads % (size + 1) >= size // 2)[:, numpy.newaxis] & numpy.isin(corners, seam)
+    corners[right] = len(positions) + numpy.searchsorted(seam, corners[right])
+    vertex = numpy.concatenate((numpy.arange(len(positions)), seam))
+    triangles = corners[:, [0, 1, 2, 0, 2, 3]].reshape((-1, 3))
+    return (vertex, positions, triangles)
+
+
+def decode_mesh(raw, params_raw=None):
+    """
+    return (positions (shape (n, 3)), triangles, {morph: (indices, deltas (shape (k, 3)))}) of an encoded xbuf.Mesh
+    (with the CustomParamList of its morphs params_raw)
+    """
+    mesh = xbuf.datas_pb2.Mesh()
+    mesh.ParseFromString(raw)
+    indices = {}
+    if params_raw is not None:
+        params = xbuf.datas_pb2.CustomParamList()
+        params.ParseFromString(params_raw)
+        indices = dict((param.name, param.vint) for param in params.params)
+    positions = None
+    morphs = {}
+    for array in mesh.vertexArrays:
+        values = numpy.array(array.floats.values, dtype=numpy.float32).reshape((-1, array.floats.step))
+        if array.attrib == POSITION and array.morph == 0:
+            positions = values
+        elif array.attrib == POSITION:
+            index = mesh.indexArrays[indices["morph%d.indices" % array.morph]].ints
+            assert index.step == 1 and values.shape[1] == 3
+            morphs[array.morph] = (numpy.array(index.values, dtype=numpy.int64), values)
+    indices = numpy.array(mesh.indexArrays[0].ints.values, dtype=numpy.int64)
+    if mesh.primitive == xbuf.datas_pb2.Mesh.triangle_strip:
+        triangles = mesh_utils.unstripify(indices)
+    else:
+        triangles = indices.reshape((-1, 3))
+    return (positions, triangles, morphs)
+
+
+def sorted_triangles(positions, triangles):
+    """return the triangles as sorted rows of the positions of their corners (independent of the order of vertices)"""
+    rows = []
+    for tri in positions[triangles].tolist():
+        k = tri.index(min(tri))
+        rows.append(tuple(v for corner in tri[k:] + tri[:k] for v in corner))
+    return sorted(rows)
+
+
+def test_sparse_morphs_smaller_than_dense(vertices_count=20000, keys_count=100, moved_ratio=0.02):
+    # like a facial rig: every key moves a few vertices
+    rand = numpy.random.RandomState(0)
+    arrays = mesh_utils.MeshArrays(numpy.arange(vertices_count), [], numpy.zeros((0, 3), dtype=numpy.int64))
+    morphs = []
+    dense = xbuf.datas_pb2.Mesh()
+    for i in range(keys_count):
+        moved = numpy.sort(rand.choice(vertices_count, int(vertices_count * moved_ratio), replace=False))
+        deltas = rand.randn(len(moved), 3).astype(numpy.float32)
+        morphs.append(("key%d" % i, moved, deltas))
+        values = numpy.zeros((vertices_count, 3), dtype=numpy.float32)
+        values[moved] = deltas
+        mesh_encoding.export_vertex_array(dense, POSITION, values)
+    (encoded, _, _) = mesh_encoding.encode_mesh(mesh_encoding.MeshPayload("m", "m", 0, arrays, None, False, morphs=morphs))
+    sparse_size = sum(len(raw) for _, raw in encoded)
+    assert sparse_size * 10 < dense.ByteSize()
+
+
+def test_morphs_after_reorder_and_strips():
+    (vertex, positions, triangles) = grid(12)
+    rand = numpy.random.RandomState(1)
+    # shuffled, so the vertex cache reorders the vertices
+    triangles = triangles[rand.permutation(len(triangles))]
+    morphs = []
+    for i in range(3):
+        moved = numpy.sort(rand.choice(len(positions), 20, replace=False))
+        morphs.append(("key%d" % i, moved, rand.randn(len(moved), 3).astype(numpy.float32)))
+    arrays = mesh_utils.MeshArrays(vertex, [(POSITION, positions[vertex])], triangles)
+    payload = mesh_encoding.MeshPayload("m", "m", 0, arrays, None, False, vertex_cache_size=8, triangle_strips=True, morphs=morphs)
+    (encoded, infos, kept) = mesh_encoding.encode_mesh(payload)
+    assert kept is not None and not numpy.array_equal(kept, numpy.arange(len(vertex)))
+    assert any("(used)" in txt for txt in infos), infos
+    morphs_params = [raw for field, raw in encoded if mesh_encoding.encoded_id(raw) == mesh_encoding.morphs_id("m")]
+    (decoded, decoded_triangles, decoded_morphs) = decode_mesh(dict(encoded)["meshes"], morphs_params[0])
+    numpy.testing.assert_array_equal(decoded, positions[vertex[kept]])
+    assert sorted_triangles(decoded, decoded_triangles) == sorted_triangles(positions[vertex], triangles)
+    for i, (name, moved, deltas) in enumerate(morphs):
+        # every encoded vertex of a moved blender vertex (and only them) is moved by its delta
+        (indices, values) = decoded_morphs[i + 1]
+        expected = numpy.zeros((len(positions), 3), dtype=numpy.float32)
+        expected[moved] = deltas
+        actual = numpy.zeros_like(decoded)
+        actual[indices] = values
+        numpy.testing.assert_array_equal(actual, expected[vertex[kept]])
+        assert len(indices) == numpy.count_nonzero(numpy.isin(vertex[kept], moved))
@@ -0,0 +1,63 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# entries sent on a connection (protocol imports xbuf_export, so it needs bpy)
+
+import pytest
+
+pytest.importorskip("bpy")
+
+import xbuf  # noqa: E402
+import xbuf.datas_pb2  # noqa: E402
+
+from blender_io_xbuf import protocol  # noqa: E402
+
+
+def make_data(color):
+    data = xbuf.datas_pb2.Data()
+    material = data.materials.add()
+    material.id = "m"
+    material.color.r = color
+    tobject = data.tobjects.add()
+    tobject.id = "o"
+    rel = data.relations.add()
+    rel.ref1 = "m"
+    rel.ref2 = "o"
+    return data
+
+
+def test_sent_data_suppresses_unchanged_entries():
+    sent = protocol.SentData()
+    encoded = [("meshes", b"\x0a\x04mesh")]
+    entries = protocol.data_entries(make_data(1.0), encoded)
+    assert len(sent.filter(entries)) == 4
+    # same entries: nothing sent
+    assert sent.filter(protocol.data_entries(make_data(1.0), encoded)) == []
+    assert sent.suppressed_count == 4 and sent.suppressed_bytes == sent.sent_bytes
+    # only the changed material is sent
+    kept = sent.filter(protocol.data_entries(make_data(0.5), encoded))
+    assert [field for field, _ in kept] == ["materials"]
+
+
+def test_sent_data_resends_after_forget():
+    sent = protocol.SentData()
+    entries = protocol.data_entries(make_data(1.0), [])
+    sent.filter(entries)
+    # the deleted entity and relation are sent again when they are created again
+    sent.forget(["o"], [("m", "o")])
+    kept = sent.filter(entries)
+    assert sorted(field for field, _ in kept) == ["relations", "tobjects"]
@@ -0,0 +1,144 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# compare the batch tbn functions of mesh_utils with a per vertex port of the mathutils computation
+# (xbuf_export.tbn_from_normal, tbn_from_loop, cnv_toQuatZupToYup), signs of quaternions included
+
+import math
+import numpy
+
+from blender_io_xbuf import mesh_utils
+
+MAX_ERROR = 1e-5
+
+
+def mat3_to_quat(mat):
+    """port of mat3_to_quat of blender (math_rotation.c), mat is mat[column][row]"""
+    mat = [normalize(col) for col in mat]
+    tr = 0.25 * (1.0 + mat[0][0] + mat[1][1] + mat[2][2])
+    if tr > 1e-4:
+        s = math.sqrt(tr)
+        q = [s, (mat[1][2] - mat[2][1]) / (4.0 * s), (mat[2][0] - mat[0][2]) / (4.0 * s), (mat[0][1] - mat[1][0]) / (4.0 * s)]
+    elif mat[0][0] > mat[1][1] and mat[0][0] > mat[2][2]:
+        s = 2.0 * math.sqrt(1.0 + mat[0][0] - mat[1][1] - mat[2][2])
+        q = [(mat[1][2] - mat[2][1]) / s, 0.25 * s, (mat[1][0] + mat[0][1]) / s, (mat[2][0] + mat[0][2]) / s]
+    elif mat[1][1] > mat[2][2]:
+        s = 2.0 * math.sqrt(1.0 + mat[1][1] - mat[0][0] - mat[2][2])
+        q = [(mat[2][0] - mat[0][2]) / s, (mat[1][0] + mat[0][1]) / s, 0.25 * s, (mat[2][1] + mat[1][2]) / s]
+    else:
+        s = 2.0 * math.sqrt(1.0 + mat[2][2] - mat[0][0] - mat[1][1])
+        q = [(mat[0][1] - mat[1][0]) / s, (mat[2][0] + mat[0][2]) / s, (mat[2][1] + mat[1][2]) / s, 0.25 * s]
+    return normalize(q)
+
+
+def quat_to_mat3(q):
+    """port of quat_to_mat3 of blender (math_rotation.c), return mat[column][row]"""
+    (q0, q1, q2, q3) = [math.sqrt(2.0) * v for v in q]
+    return [
+        [1.0 - q2 * q2 - q3 * q3, q0 * q3 + q1 * q2, -q0 * q2 + q1 * q3],
+        [-q0 * q3 + q1 * q2, 1.0 - q1 * q1 - q3 * q3, q0 * q1 + q2 * q3],
+        [q0 * q2 + q1 * q3, -q0 * q1 + q2 * q3, 1.0 - q1 * q1 - q2 * q2],
+    ]
+
+
+def normalize(v):
+    length = math.sqrt(sum(x * x for x in v))
+    return [x / length for x in v] if length > 0 else list(v)
+
+
+def cross(a, b):
+    return [a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]]
+
+
+def invert(q):
+    return [q[0], -q[1], -q[2], -q[3]]
+
+
+def tbn_from_normal(normal):
+    n = normalize(normal)
+    m = math.sqrt(2.0 + 2.0 * n[2])
+    if m == 0:
+        return [0.0, 0.0, -1.0, 0.0]
+    w = [x / m for x in cross(n, (0.0, 0.0, 1.0))]
+    return invert([0.5 * m, w[0], w[1], w[2]])
+
+
+def tbn_from_loop(n, t, bitangent_sign):
+    b = [bitangent_sign * x for x in cross(n, t)]
+    # Matrix((t, b, n)) has the rows t, b, n
+    return invert(mat3_to_quat([[t[0], b[0], n[0]], [t[1], b[1], n[1]], [t[2], b[2], n[2]]]))
+
+
+def cnv_toQuatZupToYup(q):
+    """port of Quaternion.rotate(Quaternion((-1, 1, 0, 0)).normalized()), return (x, y, z, w)"""
+    self_mat = quat_to_mat3(normalize(q))
+    other_mat = quat_to_mat3(normalize([-1.0, 1.0, 0.0, 0.0]))
+    # mul_m3_m3m3(r, other, self)
+    r = [[sum(self_mat[i][k] * other_mat[k][j] for k in range(3)) for j in range(3)] for i in range(3)]
+    (w, x, y, z) = mat3_to_quat(r)
+    return [x, y, z, w]
+
+
+def sample_normals():
+    rand = numpy.random.RandomState(4)
+    axes = [(0, 0, 1), (0, 0, -1), (1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0.3, -0.2, -0.9), (1e-7, 0, -1)]
+    return numpy.vstack((numpy.array(axes, dtype=numpy.float32), rand.randn(200, 3).astype(numpy.float32)))
+
+
+def sample_tangents(normals):
+    """unit tangents orthogonal to the normals (like calc_tangents)"""
+    rand = numpy.random.RandomState(5)
+    n = normals / numpy.linalg.norm(normals, axis=1)[:, numpy.newaxis]
+    t = rand.randn(len(n), 3)
+    t -= n * numpy.sum(t * n, axis=1)[:, numpy.newaxis]
+    return (n.astype(numpy.float32), (t / numpy.linalg.norm(t, axis=1)[:, numpy.newaxis]).astype(numpy.float32))
+
+
+def assert_same(expected, actual):
+    error = numpy.abs(numpy.array(expected) - actual).max()
+    assert error < MAX_ERROR, "max error %g" % error
+
+
+def test_tbn_from_normal_array():
+    normals = sample_normals()
+    assert_same([tbn_from_normal(n) for n in normals.tolist()], mesh_utils.tbn_from_normal_array(normals))
+
+
+def test_tbn_from_loop_array():
+    (normals, tangents) = sample_tangents(sample_normals())
+    signs = numpy.where(numpy.arange(len(normals)) % 3 == 0, -1.0, 1.0).astype(numpy.float32)
+    expected = [tbn_from_loop(n, t, s) for n, t, s in zip(normals.tolist(), tangents.tolist(), signs.tolist())]
+    assert_same(expected, mesh_utils.tbn_from_loop_array(normals, tangents, signs))
+
+
+def test_mat3_to_quat_array_pivots():
+    # rotations of ~180 degrees go through the x, y and z pivots (trace ~0)
+    rows = numpy.array([
+        [(1, 0, 0), (0, -1, 0), (0, 0, -1)],
+        [(-1, 0, 0), (0, 1, 0), (0, 0, -1)],
+        [(-1, 0, 0), (0, -1, 0), (0, 0, 1)],
+        [(0, 1, 0), (1, 0, 0), (0, 0, -1)],
+        [(0, 0, 1), (0, 1, 0), (-1, 0, 0)],
+    ], dtype=numpy.float64)
+    expected = [mat3_to_quat(numpy.transpose(r).tolist()) for r in rows]
+    assert_same(expected, mesh_utils.mat3_to_quat_array(rows))
+
+
+def test_cnv_toQuatZupToYup_array():
+    (normals, tangents) = sample_tangents(sample_normals())
+    quats = numpy.vstack((mesh_utils.tbn_from_normal_array(normals), mesh_utils.tbn_from_loop_array(normals, tangents, numpy.ones(len(normals)))))
+    assert_same([cnv_toQuatZupToYup(q) for q in quats.tolist()], mesh_utils.cnv_toQuatZupToYup_array(quats))
@@ -0,0 +1,124 @@
+# This file is part of blender_io_xbuf.  blender_io_xbuf is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright David Bernard
+
+# <pep8 compliant>
+
+# parts of xbuf_export, they need bpy (run into blender, or with the bpy module)
+
+import pytest
+
+pytest.importorskip("bpy")
+
+from blender_io_xbuf import mesh_encoding  # noqa: E402
+from blender_io_xbuf import xbuf_export  # noqa: E402
+
+
+def messages(name, size):
+    return [("meshes", name.encode("utf-8").ljust(size, b"."))]
+
+
+def test_mesh_cache_lru_eviction_by_size():
+    cache = xbuf_export.MeshCache(100)
+    cache.store("a", [(0, "mesh a")], messages("a", 40))
+    cache.store("b", [(0, "mesh b")], messages("b", 40))
+    encoder = mesh_encoding.MeshEncoder()
+    # a is used, so b is the least recently used
+    assert cache.restore("a", encoder) == [(0, "mesh a")]
+    cache.store("c", [(0, "mesh c")], messages("c", 40))
+    assert cache.size == 80
+    assert cache.restore("b", encoder) is None
+    assert cache.restore("a", encoder) is not None
+    assert cache.restore("c", encoder) is not None
+    # restored messages go into the encoder
+    assert [raw[:1] for _, raw in encoder.results(lambda txt: None)] == [b"a", b"a", b"c"]
+
+
+def test_mesh_cache_store_replaces_and_skips_too_large():
+    cache = xbuf_export.MeshCache(100)
+    cache.store("a", [], messages("a", 40))
+    cache.store("a", [], messages("a", 60))
+    assert cache.size == 60
+    cache.store("b", [], messages("b", 101))
+    assert cache.size == 60 and cache.restore("b", mesh_encoding.MeshEncoder()) is None
+    cache.discard("a")
+    assert cache.size == 0
+
+
+def test_persistent_key_stable_over_renames_and_reloads():
+    import bpy
+    mesh = bpy.data.meshes.new("persistent_key_mesh")
+    obj = bpy.data.objects.new("persistent_key_obj", mesh)
+    try:
+        key = xbuf_export.persistent_key(obj)
+        assert key != xbuf_export.persistent_key(mesh)
+        obj.name = "persistent_key_renamed"
+        assert xbuf_export.persistent_key(obj) == key
+        # reload of the addon (the uuid is stored into the datablock)
+        xbuf_export._uuid_of_name.clear()
+        xbuf_export._name_of_uuid.clear()
+        assert xbuf_export.persistent_key(obj) == key
+        # undo to a state without the custom property
+        del obj[xbuf_export.UUID_PROPERTY]
+        assert xbuf_export.persistent_key(obj) == key
+        # a copy has the custom property of its original, but not its key
+        copy = obj.copy()
+        try:
+            assert xbuf_export.persistent_key(copy) != key
+            assert xbuf_export.persistent_key(obj) == key
+        finally:
+            bpy.data.objects.remove(copy)
+    finally:
+        bpy.data.objects.remove(obj)
+        bpy.data.meshes.remove(mesh)
+
+
+def export_tobjects(cfg, exported, referenced=()):
+    """
+    simulate an export: the datablocks (any value, see persistent_key) exported are checked by need_update,
+    and exported as TObjects (if updated) related to the first one, the referenced are only used with id_of
+    """
+    import xbuf.datas_pb2
+    data = xbuf.datas_pb2.Data()
+    cfg.begin_sync()
+    for v in referenced:
+        cfg.id_of(v)
+    for v in exported:
+        if cfg.need_update(v):
+            data.tobjects.add().id = cfg.id_of(v)
+            if v != exported[0]:
+                xbuf_export.add_relation_raw(data.relations, "TObject", cfg.id_of(exported[0]), "TObject", cfg.id_of(v), cfg)
+    cfg.end_sync(data, [])
+    return data
+
+
+def test_end_sync_deletes_hidden_datablocks():
+    cfg = xbuf_export.ExportCfg()
+    try:
+        (a, b) = ("object a", "object b")
+        data = export_tobjects(cfg, [a, b])
+        assert len(data.tobjects) == 2 and cfg.pop_deleted() == ([], [])
+        # unchanged: nothing exported, nothing deleted
+        data = export_tobjects(cfg, [a, b])
+        assert len(data.tobjects) == 0 and cfg.pop_deleted() == ([], [])
+        # b hidden, but still referenced (eg parent of an instance): b and its relation are deleted
+        export_tobjects(cfg, [a], [b])
+        assert cfg.pop_deleted() == ([cfg.id_of(b)], [(cfg.id_of(a), cfg.id_of(b))])
+        assert cfg.pop_deleted() == ([], [])
+        # b visible again: exported again (a is unchanged, its relation with b is exported with b)
+        data = export_tobjects(cfg, [a, b])
+        assert [tobject.id for tobject in data.tobjects] == [cfg.id_of(b)]
+        assert len(data.relations) == 1 and cfg.pop_deleted() == ([], [])
+    finally:
+        cfg.close()
@@ -0,0 +1,128 @@
+import bpy
+import sys
+import time
+import importlib
+
+# Run this as the following blender command (the addon should be installed).
+#   blender --background --python bench_mesh_export.py -- [<subdivisions> [<addon module name>]]
+# It compares the per face export of vertex arrays (reference) with the bulk export of xbuf_export.
+
+args = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+subdivisions = int(args[0]) if len(args) > 0 else 500
+module_name = args[1] if len(args) > 1 else "blender_io_xbuf"
+xbuf_export = importlib.import_module(module_name + ".xbuf_export")
+mesh_encoding = importlib.import_module(module_name + ".mesh_encoding")
+import xbuf.datas_pb2
+
+
+def ref_positions(src_mesh, dst_mesh, material_index):
+    vertices = src_mesh.vertices
+    dst = dst_mesh.vertexArrays.add()
+    dst.attrib = xbuf.datas_pb2.VertexArray.position
+    dst.floats.step = 3
+    floats = []
+    for face in src_mesh.tessfaces:
+        if material_index != face.material_index:
+            continue
+        for i in face.vertices:
+            floats.extend(xbuf_export.cnv_toVec3ZupToYup(vertices[i].co))
+    dst.floats.values.extend(floats)
+
+
+def ref_index(src_mesh, dst_mesh, material_index):
+    dst = dst_mesh.indexArrays.add()
+    dst.ints.step = 3
+    ints = []
+    idx = 0
+    for face in src_mesh.tessfaces:
+        if material_index != face.material_index:
+            continue
+        ints.extend((idx, idx + 1, idx + 2))
+        if len(face.vertices) == 4:
+            ints.extend((idx, idx + 2, idx + 3))
+        idx += len(face.vertices)
+    dst.ints.values.extend(ints)
+
+
+def ref_texcoords(src_mesh, dst_mesh, material_index):
+    for uvI in range(min(9, len(src_mesh.tessface_uv_textures))):
+        texcoordFace = src_mesh.tessface_uv_textures[uvI].data
+        dst = dst_mesh.vertexArrays.add()
+        dst.attrib = xbuf.datas_pb2.VertexArray.texcoord + uvI
+        dst.floats.step = 2
+        floats = []
+        for face in src_mesh.tessfaces:
+            if material_index != face.material_index:
+                continue
+            ftc = texcoordFace[face.index]
+            floats.extend(ftc.uv1)
+            floats.extend(ftc.uv2)
+            floats.extend(ftc.uv3)
+            if len(face.vertices) == 4:
+                floats.extend(ftc.uv4)
+        dst.floats.values.extend(floats)
+
+
+def check_tbns(src_mesh):
+    """compare the batch tbn functions with the per vertex ones (quaternions q and -q are the same rotation)"""
+    import numpy
+    uvmap = src_mesh.uv_layers.active.name
+    src_mesh.calc_tangents(uvmap=uvmap)
+    loops = src_mesh.loops
+    vertices = [src_mesh.vertices[loop.vertex_index] for loop in loops]
+    for (label, f, f_array, items, read) in [
+        ("tbn_from_normal", xbuf_export.tbn_from_normal, xbuf_export.mesh_utils.tbn_from_normal_array, vertices,
+            lambda: (xbuf_export.foreach_array(src_mesh.vertices, "normal", 3)[[v.index for v in vertices]],)),
+        ("tbn_from_loop", xbuf_export.tbn_from_loop, xbuf_export.mesh_utils.tbn_from_loop_array, loops,
+            lambda: (xbuf_export.foreach_array(loops, "normal", 3), xbuf_export.foreach_array(loops, "tangent", 3), xbuf_export.foreach_array(loops, "bitangent_sign", 1)[:, 0])),
+    ]:
+        start = time.perf_counter()
+        expected = numpy.array([xbuf_export.cnv_toQuatZupToYup(f(item)) for item in items])
+        duration = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = xbuf_export.mesh_utils.cnv_toQuatZupToYup_array(f_array(*read()))
+        duration_array = time.perf_counter() - start
+        error = numpy.minimum(numpy.abs(expected - actual).max(axis=1), numpy.abs(expected + actual).max(axis=1))
+        print("%s: max error %g, per vertex %.3fs, batch %.3fs" % (label, error.max(), duration, duration_array))
+        assert error.max() < 1e-5, "%s: the batch quaternions differ from the per vertex ones" % label
+
+
+def bench(label, f):
+    dst = xbuf.datas_pb2.Mesh()
+    start = time.perf_counter()
+    f(dst)
+    duration = time.perf_counter() - start
+    print("%s: %.3fs" % (label, duration))
+    return dst, duration
+
+
+def main():
+    bpy.ops.mesh.primitive_grid_add(x_subdivisions=subdivisions, y_subdivisions=subdivisions)
+    obj = bpy.context.active_object
+    bpy.ops.mesh.uv_texture_add()
+    src_mesh = obj.to_mesh(bpy.context.scene, True, 'RENDER', True, False)
+    print("mesh: %d vertices, %d faces" % (len(src_mesh.vertices), len(src_mesh.tessfaces)))
+
+    def ref(dst):
+        ref_positions(src_mesh, dst, 0)
+        ref_index(src_mesh, dst, 0)
+        ref_texcoords(src_mesh, dst, 0)
+
+    def bulk(dst):
+        corners = xbuf_export.MeshCorners(src_mesh)
+        selected = corners.select(0)
+        mesh_encoding.export_vertex_array(dst, xbuf.datas_pb2.VertexArray.position, xbuf_export.corner_positions(src_mesh, corners, selected))
+        mesh_encoding.export_index(dst, xbuf_export.corner_triangles(corners, 0))
+        for attrib, values in xbuf_export.corner_texcoords(src_mesh, corners, selected):
+            mesh_encoding.export_vertex_array(dst, attrib, values)
+
+    (ref_mesh, ref_duration) = bench("per face", ref)
+    (bulk_mesh, bulk_duration) = bench("bulk", bulk)
+    print("same output: %r" % (ref_mesh.SerializeToString() == bulk_mesh.SerializeToString()))
+    print("speedup: x%.1f" % (ref_duration / max(bulk_duration, 0.000001)))
+    check_tbns(src_mesh)
+    bpy.data.meshes.remove(src_mesh)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -14,11 +14,17 @@
 # Copyright David Bernard, Riccardo Balbo
 
 # <pep8 compliant>
+import os
+import re
 import time
+import uuid
+import hashlib
+import collections
 
 import mathutils
 import bpy_extras
 import math
+import numpy
 
 import xbuf
 import xbuf.datas_pb2
@@ -28,6 +34,9 @@ import xbuf_ext.custom_params_pb2
 import xbuf_ext.animations_kf_pb2
 import xbuf_ext.physics_pb2
 from . import helpers  # pylint: disable=W0406
+from . import mesh_utils  # pylint: disable=W0406
+from . import mesh_encoding  # pylint: disable=W0406
+from . import assets  # pylint: disable=W0406
 
 
 def cnv_vec3(src, dst):
@@ -72,6 +81,11 @@ def cnv_toVec3ZupToYup(src):
     dst = [src[0], src[2], -src[1]]
     return dst
 
+def cnv_toVec3ZupToYup_array(src):
+    """same as cnv_toVec3ZupToYup for an array of vec3 (shape (n, 3))"""
+    return numpy.column_stack((src[:, 0], src[:, 2], -src[:, 1]))
+
+
 def cnv_toQuatZupToYup(src):
     # dst = xbuf.math_pb2.Quaternion()
     src0 = src.copy()
@@ -150,32 +164,160 @@ def cnv_color(src, dst):
 
 
 class ExportCfg:
-    def __init__(self, is_preview=False, assets_path="/tmp"):
+    def __init__(self, is_preview=False, assets_path="/tmp", skin_max_influences=0, mesh_cache_size=256 * 1024 * 1024, quantize_vertices=False, lod_count=0, lod_ratio=0.5, encode_workers=0, max_vertices=0, vertex_cache_size=0, triangle_strips=False, texture_workers=0, texture_strategy=assets.COPY, mesh_patches=False):
         self.is_preview = is_preview
         self.assets_path = bpy.path.abspath(assets_path)
+        # textures are written into the assets folder by texture_workers threads (0: in the current thread),
+        # texture files are materialized with texture_strategy (assets.COPY, HARDLINK, SYMLINK, REFLINK)
+        self.assets = assets.AssetsWriter(assets.AssetsManifest(os.path.normpath(os.path.expanduser(self.assets_path))), texture_workers, self.info, self.warning, texture_strategy)
+        self.weld_vertices = True
+        # 0: export every influences of vertices (variable count per vertex)
+        # N: export the N strongest influences of every vertex (fixed stride, ready for gpu)
+        self.skin_max_influences = skin_max_influences
+        self.mesh_cache = MeshCache(mesh_cache_size)
+        # export vertex arrays as quantized integers (see mesh_encoding.export_quantized_vertex_arrays),
+        # only for receivers that support it, else vertex arrays are floats
+        self.quantize_vertices = quantize_vertices
+        # number of simplified levels of detail (Mesh.lod > 0) exported with every mesh,
+        # the level n has lod_ratio ** n of the triangles of the full mesh
+        self.lod_count = lod_count
+        self.lod_ratio = lod_ratio
+        # ids of the meshes (Mesh.lod == 0) exported with coarser levels of detail by the last export,
+        # the live link sends them (and their relations) after the coarser levels (see protocol.setData)
+        self.detailed_meshes = set()
+        # split meshes into chunks (suffix "_chunk<n>") with at most max_vertices vertices (0: no split),
+        # eg 65535 for indices in 16 bits (0xffff is kept for the restart of strips), at least a triangle
+        self.max_vertices = 0 if max_vertices < 1 else max(3, max_vertices)
+        # reorder triangles and vertices of meshes for a post-transform vertex cache of this size (0: keep the order)
+        self.vertex_cache_size = vertex_cache_size
+        # export meshes as triangle strips (separated by mesh_utils.STRIP_RESTART) when the index is smaller
+        self.triangle_strips = triangle_strips
+        # send the vertices changed since the last export of a mesh with the same topology (see mesh_encoding.MeshPatcher),
+        # only for receivers that support it, else send the whole mesh
+        self.mesh_patcher = mesh_encoding.MeshPatcher() if mesh_patches else None
+        # number of processes encoding the meshes (0: in the current process)
+        self.encode_workers = encode_workers
+        self._encode_pool = None
+        # ids of the xbuf.Mesh exported for the blender meshes {id_of(mesh): [ids]}, to relate them to instances
+        self.mesh_ids = {}
+        # duplis of the duplicators {id_of(duplicator): [(persistent_key of source, persistent id, matrix_world)]},
+        # created again when the duplicator is updated (see find_instances)
+        self.duplis = {}
+        # registries by persistent_key, limited to the keys used by the last export (see end_sync)
         self._modified = {}
         self._ids = {}
+        self._seen = None
+        self._checked = None
+        # entities sent to the receiver {ref: id of its datablock} and relations {(ref1, ref2): owner ref},
+        # to find the deleted ones (see end_sync)
+        self._sent_refs = {}
+        self._sent_relations = {}
+        self._emitted_relations = {}
+        self._deleted_refs = []
+        self._deleted_relations = []
 
     def _k_of(self, v):
-        # hash(v) or id(v) ?
-        return str(hash(v))
+        k = persistent_key(v)
+        if self._seen is not None:
+            self._seen.add(k)
+        return k
 
     def id_of(self, v):
-        k = self._k_of(v)
+        return self._id_of_key(self._k_of(v))
+
+    def _id_of_key(self, k):
         if k in self._ids:
             out = self._ids[k]
         else:
-            # out = str(uuid.uuid4().clock_seq)
-            out = str(hash(v))
+            # short and stable (the key can be long and contains any character)
+            out = hashlib.sha1(k.encode("utf-8")).hexdigest()[:16]
             self._ids[k] = out
         return out
 
+    def begin_sync(self):
+        """start to record the keys used by the export (and the ones checked by need_update)"""
+        self._seen = set()
+        self._checked = set()
+        self._emitted_relations = {}
+        self.detailed_meshes = set()
+
+    def end_sync(self, data, encoded):
+        """
+        forget the keys not used since begin_sync (deleted, renamed or hidden datablocks,...),
+        so the registries don't grow, the forgotten datablocks will be exported again if used later.
+        The live datablocks are the ones exported or checked by need_update (unchanged) by the export,
+        a datablock only referenced (eg with id_of by a relation) is not live.
+        Find the entities and relations sent before and deleted since (see pop_deleted):
+        - the entities of datablocks not live
+        - the entities of exported datablocks that were not exported again (eg mesh of a removed material)
+        - the relations with a deleted entity, or owned by an exported datablock but not exported again
+        """
+        (seen, checked) = (self._seen, self._checked)
+        (self._seen, self._checked) = (None, None)
+        emitted = dict((ref, root_of(ref)) for ref in exported_refs(data, encoded))
+        live = set(self._id_of_key(k) for k in checked) | set(emitted.values())
+        for k in [k for k in self._modified if k not in checked]:
+            # exported again (as new) when it is live again
+            del self._modified[k]
+        for k in [k for k in self._ids if k not in seen]:
+            del self._ids[k]
+        for registry in (self.mesh_ids, self.duplis):
+            for k in [k for k in registry if k not in live]:
+                del registry[k]
+        if self.mesh_patcher is not None:
+            self.mesh_patcher.retain(lambda mesh_id: root_of(mesh_id) in live)
+
+        updated = set(emitted.values())
+        deleted = set(ref for ref, root in self._sent_refs.items() if ref not in emitted and (root not in live or root in updated))
+        for ref in deleted:
+            del self._sent_refs[ref]
+        self._sent_refs.update(emitted)
+        self._deleted_refs.extend(sorted(deleted))
+        for relation, owner in list(self._sent_relations.items()):
+            if relation in self._emitted_relations:
+                continue
+            if relation[0] in deleted or relation[1] in deleted or root_of(owner) in updated:
+                del self._sent_relations[relation]
+                self._deleted_relations.append(relation)
+        self._sent_relations.update(self._emitted_relations)
+        self._emitted_relations = {}
+
+    def add_relation(self, t1, ref1, t2, ref2):
+        """record the exported relation (ordered refs)"""
+        if self._seen is not None:
+            self._emitted_relations[(ref1, ref2)] = relation_owner(t1, ref1, t2, ref2)
+
+    def pop_deleted(self):
+        """return ([refs], [(ref1, ref2)]) of the entities and relations deleted since the last call"""
+        deleted = (self._deleted_refs, self._deleted_relations)
+        self._deleted_refs = []
+        self._deleted_relations = []
+        return deleted
+
     def need_update(self, v, modified=False):
         k = self._k_of(v)
+        if self._checked is not None:
+            self._checked.add(k)
         old = (k not in self._modified) or self._modified[k]
         self._modified[k] = modified
         return old
 
+    def is_updated(self, v):
+        """return the flag of v returned by need_update, without clearing it"""
+        k = self._k_of(v)
+        return (k not in self._modified) or self._modified[k]
+
+    def mesh_encoder(self):
+        if self._encode_pool is None and self.encode_workers > 0:
+            self._encode_pool = mesh_encoding.make_pool(self.encode_workers)
+        return mesh_encoding.MeshEncoder(self._encode_pool)
+
+    def close(self):
+        if self._encode_pool is not None:
+            self._encode_pool.shutdown()
+            self._encode_pool = None
+        self.assets.close()
+
     def info(self, txt):
         print("INFO: " + txt)
 
@@ -186,21 +328,303 @@ class ExportCfg:
         print("ERROR: " + txt)
 
 
+# the base type of the blender datablocks (eg Lamp for PointLamp), by type
+_id_types = {}
+# the name of the collection of bpy.data of the datablocks, by base type
+_id_collections = {}
+# custom property of the local datablocks with their uuid (saved with the file)
+UUID_PROPERTY = "xbuf_uuid"
+# {name key: uuid} and {uuid: name key} of the local datablocks, to find the uuid of a datablock after undo
+# (the custom property is undone too) and the copies of a datablock (eg duplicated object)
+_uuid_of_name = {}
+_name_of_uuid = {}
+
+
+def persistent_key(v):
+    """
+    return a key of v that is the same after undo, rename, reload of the file or of the addon:
+    type and uuid (see id_uuid) for the local datablocks, library, type and name for the linked datablocks,
+    key of the datablock and path for the other blender structs (eg bones, rigid bodies), hash(v) for the other values.
+    """
+    if isinstance(v, bpy.types.ID):
+        cls = type(v)
+        if cls not in _id_types:
+            base = cls
+            while bpy.types.ID not in base.__bases__:
+                base = base.__bases__[0]
+            _id_types[cls] = base.__name__
+        if v.library is not None:
+            return "%s:%s:%s" % (v.library.filepath, _id_types[cls], v.name)
+        uuid = id_uuid(v, _id_types[cls])
+        if uuid is None:
+            return ":%s:%s" % (_id_types[cls], v.name)
+        return ":%s#%s" % (_id_types[cls], uuid)
+    if isinstance(v, bpy.types.bpy_struct):
+        try:
+            return persistent_key(v.id_data) + ":" + v.path_from_id()
+        except ValueError:
+            pass
+    return str(hash(v))
+
+
+def id_uuid(v, base):
+    """
+    return the uuid of the local datablock v (of the base type), stored into its custom property UUID_PROPERTY:
+    created for a new datablock, found again by name after undo, created again for a copy (the custom
+    properties are copied with the datablock), None if the custom property can't be written.
+    """
+    name = "%s:%s" % (base, v.name)
+    uuid = v.get(UUID_PROPERTY)
+    if not isinstance(uuid, str):
+        uuid = _uuid_of_name.get(name)
+        if uuid is None or _name_of_uuid.get(uuid, name) != name:
+            uuid = _new_uuid()
+    else:
+        owner = _name_of_uuid.get(uuid)
+        if owner is not None and owner != name:
+            other = find_local_id(base, owner.split(":", 1)[1])
+            if other is not None and other != v and other.get(UUID_PROPERTY) == uuid:
+                # v is a copy of other (else v is other renamed)
+                uuid = _new_uuid()
+    if v.get(UUID_PROPERTY) != uuid:
+        try:
+            v[UUID_PROPERTY] = uuid
+        except (AttributeError, TypeError):
+            # the datablocks can't be written in this context
+            return None
+    _name_of_uuid.pop(_uuid_of_name.get(name), None)
+    _uuid_of_name.pop(_name_of_uuid.get(uuid), None)
+    _uuid_of_name[name] = uuid
+    _name_of_uuid[uuid] = name
+    return uuid
+
+
+def _new_uuid():
+    return uuid.uuid4().hex
+
+
+def find_local_id(base, name):
+    """return the local datablock of the base type (eg Object, Lamp) with name, or None"""
+    if len(_id_collections) == 0:
+        for prop in bpy.types.BlendData.bl_rna.properties:
+            if prop.type == 'COLLECTION':
+                _id_collections[prop.fixed_type.identifier] = prop.identifier
+    collection = _id_collections.get(base)
+    if collection is None:
+        return None
+    for v in getattr(bpy.data, collection):
+        if v.library is None and v.name == name:
+            return v
+    return None
+
+
+def root_of(ref):
+    """
+    return the id of the datablock of the entity ref, the ids of the exported entities start with
+    (or contain after a prefix like "bounds_") the id of their datablock (see ExportCfg.id_of)
+    """
+    match = re.search("[0-9a-f]{16}", ref)
+    return ref if match is None else match.group(0)
+
+
+# owner of relations by type (the first in this order), the export of the owner exports the relation
+RELATION_OWNERS = [
+    xbuf_ext.custom_params_pb2.CustomParamList.__name__,
+    xbuf.datas_pb2.Mesh.__name__,
+]
+
+
+def relation_owner(t1, ref1, t2, ref2):
+    """
+    return the ref of the end of the relation that exports it: parameters, meshes, then anything but a TObject
+    (the child, ref2, for a relation between TObjects: it's exported with the child)
+    """
+    for t in RELATION_OWNERS:
+        if t == t1 or t == t2:
+            return ref1 if t == t1 else ref2
+    if t1 == xbuf.datas_pb2.TObject.__name__:
+        return ref2
+    return ref1
+
+
+def exported_refs(data, encoded):
+    """return the ids of the entities of data and of the encoded messages (fields of data)"""
+    refs = []
+    for entities in (data.tobjects, data.materials, data.lights, data.skeletons, data.meshes, data.custom_params, data.animations_kf):
+        refs.extend(entity.id for entity in entities)
+    for physics in data.physics:
+        entity = physics.rigidbody if physics.HasField("rigidbody") else physics.constraint
+        refs.append(entity.id)
+    refs.extend(mesh_encoding.encoded_id(raw) for _, raw in encoded)
+    return [ref for ref in refs if ref != ""]
+
+
+class MeshCache:
+    """
+    LRU cache of the encoded messages exported for evaluated blender meshes (xbuf.Mesh per material
+    and the xbuf.Data entries exported with them), keyed by the fingerprint of the evaluated mesh,
+    bounded by the size of the encoded messages.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def restore(self, key, encoder):
+        """add the cached messages into encoder, return [(material_index, mesh)] or None if not cached"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        (exported, messages) = entry
+        encoder.add(messages)
+        return exported
+
+    def store(self, key, exported, messages):
+        """exported: [(material_index, mesh)], messages: [(field of xbuf.Data, encoded message)] exported with the meshes"""
+        self.discard(key)
+        size = sum(len(raw) for _, raw in messages)
+        if size > self.max_size:
+            return
+        self._entries[key] = (exported, messages)
+        self.size += size
+        while self.size > self.max_size:
+            (_, evicted) = self._entries.popitem(last=False)
+            self.size -= sum(len(raw) for _, raw in evicted[1])
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= sum(len(raw) for _, raw in entry[1])
+
+
 # TODO avoid export obj with same id
-# TODO optimize unify vertex with (same position, color, normal, texcoord,...)
 def export(scene, data, cfg):
+    """
+    export the scene into data, except the encoded meshes (and their messages) that are returned
+    as [(field of data, encoded message)], to serialize with data (see mesh_encoding.serialize_with)
+    """
     t_start = time.perf_counter()
-    export_all_tobjects(scene, data, cfg)
-    export_all_geometries(scene, data, cfg)
-    export_all_materials(scene, data, cfg)
-    export_all_lights(scene, data, cfg)
-    export_all_skeletons(scene, data, cfg)
+    # whatever the state of the datablocks that submitted them
+    cfg.assets.retry_failed()
+    cfg.begin_sync()
+    users = find_users_of_data(scene)
+    instances = find_instances(scene, cfg)
+    objects = objects_to_export(scene, instances)
+    encoder = cfg.mesh_encoder()
+    export_all_tobjects(scene, data, cfg, instances)
+    updated = export_all_geometries(scene, data, cfg, objects, users, encoder)
+    export_all_materials(objects, data, cfg)
+    updated |= export_all_lights(objects, data, cfg, users)
+    export_all_instances_relations(instances, updated, data, cfg)
+    export_all_skeletons(scene, data, cfg, users)
     export_all_actions(scene, data, cfg)
     export_all_physics(scene, data, cfg)
+    encoded = encoder.results(cfg.info)
+    cfg.end_sync(data, encoded)
+    cfg.assets.end_batch()
     t_end = time.perf_counter()
     cfg.info("export timing: %s" % (t_end - t_start))
+    return encoded
+
+def find_users_of_data(scene):
+    """return {obj.data: [objects of the scene using it]} (objects are in the order of scene.objects)"""
+    users = {}
+    for obj in scene.objects:
+        if obj.data is not None:
+            users.setdefault(obj.data, []).append(obj)
+    return users
+
+
+class Instance:
+    """
+    an instance of the object source made by the duplicator object (dupli-group, particles, dupli-verts,...),
+    exported as a TObject child of the duplicator, related to the data of source (exported once for every instances)
+    """
+
+    def __init__(self, duplicator, source, key, matrix_world, cfg):
+        self.id = cfg.id_of(duplicator) + "_dupli" + "".join("_%d" % i for i in key)
+        self.name = duplicator.name + "/" + source.name
+        self.duplicator = duplicator
+        self.source = source
+        # transform relative to the duplicator
+        self.matrix_local = duplicator.matrix_world.inverted_safe() * matrix_world
+        # True when the TObject is exported (by export_all_tobjects)
+        self.updated = False
+
 
-def export_all_tobjects(scene, data, cfg):
+def find_instances(scene, cfg):
+    """
+    return {duplicator: [Instance of meshes and lamps]} for the visible duplicators of the scene,
+    the dupli list is created only for the duplicators updated since the last export (see ExportCfg.duplis)
+    """
+    instances = collections.OrderedDict()
+    settings = 'PREVIEW' if cfg.is_preview else 'RENDER'
+    # {persistent_key: object} of the sources, the objects are not kept over exports (they are invalid after undo)
+    sources = {}
+    all_sources = False
+    for obj in scene.objects:
+        if obj.hide_render or not obj.is_duplicator:
+            continue
+        duplis = cfg.duplis.get(cfg.id_of(obj))
+        if duplis is not None and not is_duplicator_updated(obj, scene, cfg):
+            if not all_sources and any(source not in sources for source, _, _ in duplis):
+                sources.update((persistent_key(src), src) for src in bpy.data.objects)
+                all_sources = True
+            if any(source not in sources for source, _, _ in duplis):
+                # a source was removed
+                duplis = None
+        else:
+            duplis = None
+        if duplis is None:
+            duplis = []
+            obj.dupli_list_create(scene, settings)
+            try:
+                for dupli in obj.dupli_list:
+                    if not dupli.hide and dupli.object.type in ('MESH', 'LAMP'):
+                        source = persistent_key(dupli.object)
+                        sources[source] = dupli.object
+                        # persistent_id identifies the dupli over updates (levels of nesting, unused levels are INT_MAX)
+                        duplis.append((source, [i for i in dupli.persistent_id if i != 0x7fffffff], dupli.matrix.copy()))
+            finally:
+                obj.dupli_list_clear()
+            cfg.duplis[cfg.id_of(obj)] = duplis
+        instances[obj] = [Instance(obj, sources[source], key, matrix_world, cfg) for source, key, matrix_world in duplis]
+    return instances
+
+
+def is_duplicator_updated(obj, scene, cfg):
+    """
+    return True if the duplis of obj may have changed since the last export (without clearing the flags):
+    obj or its data (eg particles, vertices) is updated, or an object of its dupli group in the scene
+    (the flags of the objects out of the scene are not updated, see renderengine.SceneChangeListener)
+    """
+    if cfg.is_updated(obj) or (obj.data is not None and cfg.is_updated(obj.data)):
+        return True
+    group = obj.dupli_group if obj.dupli_type == 'GROUP' else None
+    return group is not None and any(cfg.is_updated(src) for src in group.objects if scene.objects.get(src.name) == src)
+
+
+def objects_to_export(scene, instances):
+    """
+    return the visible objects of the scene, then a source for every data instanced but not used by them
+    (eg objects of a group that is not in the scene)
+    """
+    objects = [obj for obj in scene.objects if not obj.hide_render]
+    datas = set(obj.data for obj in objects)
+    for obj_instances in instances.values():
+        for instance in obj_instances:
+            if instance.source.data not in datas:
+                datas.add(instance.source.data)
+                objects.append(instance.source)
+    return objects
+
+
+def export_all_tobjects(scene, data, cfg, instances):
     for obj in scene.objects:
         if obj.hide_render:
             continue
@@ -238,6 +662,40 @@ def export_all_tobjects(scene, data, cfg):
                 #    tobject.parentId = cfg.id_of(obj.parent)
                 add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj.parent), xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj), cfg)
             export_customproperties(obj, tobject, data, cfg)
+            for instance in instances.get(obj, []):
+                export_instance(instance, data, cfg)
+
+
+def export_instance(instance, data, cfg):
+    """export the TObject of the instance (without data, see export_all_instances_relations)"""
+    tobject = data.tobjects.add()
+    tobject.id = instance.id
+    tobject.name = instance.name
+    transform = tobject.transform
+    loc, quat, scale = instance.matrix_local.decompose()
+    cnv_scale(scale, transform.scale)
+    cnv_translation(loc, transform.translation)
+    if instance.source.type == 'LAMP':
+        cnv_quatZupToYup(helpers.z_backward_to_forward(quat), transform.rotation)
+    else:
+        cnv_rotation(quat, transform.rotation)
+    add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, cfg.id_of(instance.duplicator), xbuf.datas_pb2.TObject.__name__, instance.id, cfg)
+    instance.updated = True
+
+
+def export_all_instances_relations(instances, updated, data, cfg):
+    """relate instances to the data of their source, when the instance or the data (in updated) is exported"""
+    for obj_instances in instances.values():
+        for instance in obj_instances:
+            src_data = instance.source.data
+            if not (instance.updated or src_data in updated):
+                continue
+            if instance.source.type == 'MESH':
+                add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, instance.id, xbuf_ext.custom_params_pb2.CustomParamList.__name__, mesh_encoding.bounds_id(cfg.id_of(src_data)), cfg)
+                for mesh_id in cfg.mesh_ids.get(cfg.id_of(src_data), []):
+                    add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh_id, xbuf.datas_pb2.TObject.__name__, instance.id, cfg)
+            elif instance.source.type == 'LAMP':
+                add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, instance.id, xbuf.datas_pb2.Light.__name__, cfg.id_of(src_data), cfg)
 
 def export_all_physics(scene, data, cfg):
     for obj in scene.objects:
@@ -387,27 +845,29 @@ def export_rb(ob, phy_data, data, cfg):
     return phy_data
 
 
-def export_all_geometries(scene, data, cfg):
-    for obj in scene.objects:
-        if obj.hide_render:
-            continue
+def export_all_geometries(scene, data, cfg, objects, users, encoder):
+    """export the meshes of objects, return the set of exported blender meshes"""
+    updated = set()
+    for obj in objects:
         if obj.type == 'MESH':
             if len(obj.data.polygons) != 0 and cfg.need_update(obj.data):
-                meshes = export_meshes(obj, data.meshes, scene, cfg)
-                for material_index, mesh in meshes.items():
+                meshes = export_meshes(obj, data, encoder, scene, cfg)
+                updated.add(obj.data)
+                cfg.mesh_ids[cfg.id_of(obj.data)] = [mesh.id for _, mesh in meshes]
+                for obj2 in users.get(obj.data, []):
+                    add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj2), xbuf_ext.custom_params_pb2.CustomParamList.__name__, mesh_encoding.bounds_id(cfg.id_of(obj.data)), cfg)
+                for material_index, mesh in meshes:
                     export_customproperties(obj.data, mesh, data, cfg)
-                    # several object can share the same mesh
-                    for obj2 in scene.objects:
-                        if obj2.data == obj.data:
-                            add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh.id, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj2), cfg)
+                    # several object can share the same mesh (instances are related by export_all_instances_relations)
+                    for obj2 in users.get(obj.data, []):
+                        add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh.id, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj2), cfg)
                     if material_index > -1 and material_index < len(obj.material_slots):
                         src_mat = obj.material_slots[material_index].material
                         add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh.id, xbuf.datas_pb2.Material.__name__, cfg.id_of(src_mat), cfg)
+    return updated
 
-def export_all_materials(scene, data, cfg):
-    for obj in scene.objects:
-        if obj.hide_render:
-            continue
+def export_all_materials(objects, data, cfg):
+    for obj in objects:
         if obj.type == 'MESH':
             for i in range(len(obj.material_slots)):
                 src_mat = obj.material_slots[i].material
@@ -417,17 +877,22 @@ def export_all_materials(scene, data, cfg):
                     export_customproperties(src_mat, dst_mat, data, cfg)
 
 
-def export_all_lights(scene, data, cfg):
-    for obj in scene.objects:
-        if obj.hide_render:
-            continue
+def export_all_lights(objects, data, cfg, users):
+    """export the lights of objects, return the set of exported blender lamps"""
+    updated = set()
+    for obj in objects:
         if obj.type == 'LAMP':
             src_light = obj.data
             if cfg.need_update(src_light):
                 dst_light = data.lights.add()
                 export_light(src_light, dst_light, cfg)
                 export_customproperties(src_light, dst_light, data, cfg)
-                add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj), xbuf.datas_pb2.Light.__name__, cfg.id_of(src_light), cfg)
+                updated.add(src_light)
+                # several object can share the same light (instances are related by export_all_instances_relations)
+                for obj2 in users.get(src_light, []):
+                    if not obj2.hide_render:
+                        add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj2), xbuf.datas_pb2.Light.__name__, cfg.id_of(src_light), cfg)
+    return updated
 
 
 def add_relation(relations, e1, e2, cfg):
@@ -435,18 +900,20 @@ def add_relation(relations, e1, e2, cfg):
 
 
 def add_relation_raw(relations, t1, ref1, t2, ref2, cfg):
+    if t1 > t2:
+        (t1, ref1, t2, ref2) = (t2, ref2, t1, ref1)
     rel = relations.add()
-    if t1 <= t2:
-        rel.ref1 = ref1
-        rel.ref2 = ref2
-        cfg.info("add relation: '%s'(%s) to '%s'(%s)" % (t1, ref1, t2, ref2))
-    else:
-        rel.ref1 = ref2
-        rel.ref2 = ref1
-        cfg.info("add relation: '%s'(%s) to '%s'(%s)" % (t2, ref2, t1, ref1))
+    rel.ref1 = ref1
+    rel.ref2 = ref2
+    cfg.add_relation(t1, ref1, t2, ref2)
+    cfg.info("add relation: '%s'(%s) to '%s'(%s)" % (t1, ref1, t2, ref2))
 
 
-def export_meshes(src_geometry, meshes, scene, cfg):
+def export_meshes(src_geometry, data, encoder, scene, cfg):
+    """
+    submit the encoding of the meshes of src_geometry to encoder,
+    return [(material_index, mesh)] with mesh only the header (id, name, lod) of the encoded mesh
+    """
     mode = 'PREVIEW' if cfg.is_preview else 'RENDER'
     # Set up modifiers whether to apply deformation or not
     # tips from https://code.google.com/p/blender-cod/source/browse/blender_26/export_xmodel.py#185
@@ -467,37 +934,102 @@ def export_meshes(src_geometry, meshes, scene, cfg):
     for mod in mod_armature:
         setattr(mod[0], mod_state_attr, mod[1])
 
-    # dst.id = cfg.id_of(src_geometry.data)
-    # dst.name = src_geometry.name
-    faces = src_mesh.tessfaces
-    dstMap = {}
-    for face in faces:
-        material_index = face.material_index
-        if material_index not in dstMap:
-            dstMap[material_index] = meshes.add()
-
-    for material_index, dst in dstMap.items():
-        src_mat = None if material_index >= len(src_geometry.material_slots) else src_geometry.material_slots[material_index].material
-        dst.primitive = xbuf.datas_pb2.Mesh.triangles
-        dst.id = cfg.id_of(src_mesh) + "_" + str(material_index)
-        dst.name = src_geometry.data.name + "_" + str(material_index)
-        # unified_vertex_array = unify_vertices(vertex_array, index_table)
-        export_positions(src_mesh, dst, material_index)
-        #export_normals(src_mesh, dst, material_index)
-        export_tbns(src_mesh, dst, material_index, src_mat)
-        export_index(src_mesh, dst, material_index)
-        export_colors(src_mesh, dst, material_index)
-        export_texcoords(src_mesh, dst, material_index)
-
-        # # -- with armature applied
-        # for mod in mod_armature:
-        #     setattr(mod[0], mod_state_attr, True)
-        # src_mesh = src_geometry.to_mesh(scene, True, mode, True, False)
-        # # Restore modifier settings
-        # for mod in mod_armature:
-        #     setattr(mod[0], mod_state_attr, mod[1])
-        export_skin(src_mesh, src_geometry, dst, cfg, material_index)
-    return dstMap
+    corners = MeshCorners(src_mesh)
+    fingerprint = mesh_fingerprint(src_mesh, src_geometry, corners, cfg)
+    # the levels of detail are cached apart (they are never patched), and added first (coarsest first)
+    lods_key = fingerprint + "_lods"
+    exported = None
+    if fingerprint in cfg.mesh_cache and (cfg.lod_count < 1 or lods_key in cfg.mesh_cache):
+        cfg.mesh_cache.restore(lods_key, encoder)
+        exported = cfg.mesh_cache.restore(fingerprint, encoder)
+    patched = set()
+    if exported is None:
+        (exported, payloads) = export_evaluated_meshes(src_mesh, src_geometry, corners, cfg)
+        lods = sorted([payload for payload in payloads if payload.lod > 0], key=lambda payload: -payload.lod)
+        payloads = [payload for payload in payloads if payload.lod == 0]
+        if len(lods) > 0 and cfg.mesh_cache.restore(lods_key, encoder) is None:
+            encoder.submit(lods, lambda results: cfg.mesh_cache.store(lods_key, [], [message for encoded, _ in results for message in encoded]))
+        patcher = cfg.mesh_patcher
+        full = payloads
+        if patcher is not None:
+            full = []
+            for payload in payloads:
+                patch = patcher.patch(payload)
+                if patch is None:
+                    full.append(payload)
+                else:
+                    encoder.add(patch)
+                    patched.add(payload.id)
+            if len(patched) > 0:
+                cfg.info("patch vertices of %r: %d / %d meshes" % (src_geometry.data.name, len(patched), len(payloads)))
+
+        def done(results):
+            if patcher is not None:
+                for payload, (_, kept) in zip(full, results):
+                    patcher.sent(payload, kept)
+            # patches are not cached (they are relative to the last mesh sent)
+            if len(patched) == 0:
+                cfg.mesh_cache.store(fingerprint, exported, [message for encoded, _ in results for message in encoded])
+        encoder.submit(full, done)
+    else:
+        cfg.info("reuse meshes of %r (evaluated mesh unchanged)" % (src_geometry.data.name))
+        if cfg.mesh_patcher is not None:
+            for _, mesh in exported:
+                cfg.mesh_patcher.forget(mesh.id)
+    if cfg.lod_count > 0:
+        cfg.detailed_meshes.update(mesh.id for _, mesh in exported if mesh.lod == 0)
+    has_morphs = len(shape_key_morphs(src_geometry, corners, cfg)) > 0
+    # bounds of the meshes of src_geometry together (for the objects using them, see export_all_geometries)
+    mesh_encoding.export_bounds(data.custom_params.add(), mesh_encoding.bounds_id(cfg.id_of(src_geometry.data)), mesh_utils.bounds(cnv_toVec3ZupToYup_array(corners.vertex_array("co"))))
+    bpy.data.meshes.remove(src_mesh)
+    for _, mesh in exported:
+        add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh.id, xbuf_ext.custom_params_pb2.CustomParamList.__name__, mesh_encoding.bounds_id(mesh.id), cfg)
+        if cfg.quantize_vertices:
+            add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh.id, xbuf_ext.custom_params_pb2.CustomParamList.__name__, mesh_encoding.quantization_id(mesh.id), cfg)
+        if has_morphs:
+            add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh.id, xbuf_ext.custom_params_pb2.CustomParamList.__name__, mesh_encoding.morphs_id(mesh.id), cfg)
+        if mesh.id in patched:
+            add_relation_raw(data.relations, xbuf.datas_pb2.Mesh.__name__, mesh.id, xbuf_ext.custom_params_pb2.CustomParamList.__name__, mesh_encoding.patch_id(mesh.id), cfg)
+    return exported
+
+
+def export_evaluated_meshes(src_mesh, src_geometry, corners, cfg):
+    """
+    extract src_mesh (evaluated src_geometry) as one xbuf.Mesh per material (and per level of detail),
+    return ([(material_index, mesh header)], [mesh_encoding.MeshPayload])
+    """
+    exported = []
+    payloads = []
+    morphs = shape_key_morphs(src_geometry, corners, cfg)
+    for material_index in corners.materials():
+        src_mat = material_of(src_geometry, material_index)
+        # the evaluated src_mesh is temporary, the id is the one of its source
+        mesh_id = cfg.id_of(src_geometry.data) + "_" + str(material_index)
+        mesh_name = src_geometry.data.name + "_" + str(material_index)
+        arrays = extract_mesh_arrays(src_mesh, corners, material_index, src_mat, cfg)
+        if cfg.weld_vertices:
+            corners_count = arrays.vertices_count()
+            arrays = mesh_utils.weld(arrays)
+            cfg.info("weld vertices of %r: %d -> %d (x%.2f)" % (mesh_name, corners_count, arrays.vertices_count(), corners_count / max(1, arrays.vertices_count())))
+        chunks = [arrays] if cfg.max_vertices < 1 else mesh_utils.split(arrays, cfg.max_vertices)
+        if len(chunks) > 1:
+            cfg.info("split %r into %d chunks of at most %d vertices" % (mesh_name, len(chunks), cfg.max_vertices))
+        for chunk_index, chunk in enumerate(chunks):
+            skin = None
+            # the levels of detail of a chunk are decimated by the encoder (see MeshPayload.lod_triangles),
+            # the borders of the chunk are kept, so the levels of the chunks fit together
+            for lod in range(cfg.lod_count + 1):
+                suffix = ("" if lod == 0 else "_lod" + str(lod)) + ("" if len(chunks) == 1 else "_chunk" + str(chunk_index))
+                dst = xbuf.datas_pb2.Mesh()
+                dst.id = mesh_id + suffix
+                dst.name = mesh_name + suffix
+                dst.lod = lod
+                if lod == 0:
+                    skin = skin_arrays(src_geometry, dst.name, cfg, corners, chunk.vertex)
+                lod_triangles = 0 if lod == 0 else max(1, int(len(chunk.triangles) * cfg.lod_ratio ** lod))
+                payloads.append(mesh_encoding.MeshPayload(dst.id, dst.name, dst.lod, chunk, skin, cfg.quantize_vertices, cfg.vertex_cache_size, cfg.triangle_strips, morphs, lod_triangles))
+                exported.append((material_index, dst))
+    return (exported, payloads)
 
 
 # FIXME side effect on the original scene (selection, and transform of the src_geometry)
@@ -510,66 +1042,170 @@ def apply_transform(src_geometry):
     # src_geometry.select = False # we're done working on this object
 
 
-def export_positions(src_mesh, dst_mesh, material_index):
-    vertices = src_mesh.vertices
-    dst = dst_mesh.vertexArrays.add()
-    dst.attrib = xbuf.datas_pb2.VertexArray.position
-    dst.floats.step = 3
-    floats = []
-    faces = src_mesh.tessfaces
-    for face in faces:
-        if material_index != face.material_index:
-            continue
-        floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[0]].co))
-        floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[1]].co))
-        floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[2]].co))
-        if len(face.vertices) == 4:
-            floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[3]].co))
-
-    # for v in vertices:
-    #     floats.extend(v.co)
-    dst.floats.values.extend(floats)
-
-
-def export_normals(src_mesh, dst_mesh, material_index):
-    vertices = src_mesh.vertices
-    dst = dst_mesh.vertexArrays.add()
-    dst.attrib = xbuf.datas_pb2.VertexArray.normal
-    dst.floats.step = 3
-    floats = []
-    faces = src_mesh.tessfaces
-    for face in faces:
-        if material_index != face.material_index:
-            continue
-        floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[0]].normal))
-        floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[1]].normal))
-        floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[2]].normal))
-        if len(face.vertices) == 4:
-            floats.extend(cnv_toVec3ZupToYup(vertices[face.vertices[3]].normal))
-    # for v in vertices:
-    #     floats.extend(v.normal)
-    dst.floats.values.extend(floats)
-
-def export_tbns(src_mesh, dst_mesh, material_index, src_mat):
-    #return
-    dst = dst_mesh.vertexArrays.add()
-    dst.attrib = xbuf.datas_pb2.VertexArray.tbn_to_model_quat
-    dst.floats.step = 4
-    floats = []
-    (tbn_fct, faces, fvertices_fct) = find_tbn_fct(src_mesh, material_index, src_mat)
-    for face in faces:
-        if material_index != face.material_index:
-            continue
-        fvertices = fvertices_fct(face)
-        for vertex in fvertices:
-            floats.extend(cnv_toQuatZupToYup(tbn_fct(vertex)))
-        #floats.extend(cnv_toQuatZupToYup(tbn_fct(vertices[face.vertices[1]])))
-        #floats.extend(cnv_toQuatZupToYup(tbn_fct(vertices[face.vertices[2]])))
-        #if len(face.vertices) == 4:
-        #    floats.extend(cnv_toQuatZupToYup(tbn_fct(vertices[face.vertices[3]])))
-    # for v in vertices:
-    #     floats.extend(v.normal)
-    dst.floats.values.extend(floats)
+def material_of(src_geometry, material_index):
+    return None if material_index >= len(src_geometry.material_slots) else src_geometry.material_slots[material_index].material
+
+
+def mesh_fingerprint(src_mesh, src_geometry, corners, cfg):
+    """return a digest of everything read from the evaluated src_mesh (and its settings) to export it"""
+    digest = hashlib.sha1()
+    settings = [cfg.id_of(src_geometry.data), src_geometry.data.name, cfg.weld_vertices, cfg.skin_max_influences, cfg.quantize_vertices, cfg.lod_count, cfg.lod_ratio, cfg.max_vertices, cfg.vertex_cache_size, cfg.triangle_strips]
+    arrays = [corners.face_vertices, corners.face_material, corners.vertex_array("co"), corners.vertex_array("normal")]
+    if len(src_mesh.tessface_vertex_colors) > 0:
+        arrays.append(corners.face_colors())
+    for uvI in range(min(9, len(src_mesh.tessface_uv_textures))):
+        arrays.append(corners.face_uvs(uvI))
+    for material_index in corners.materials():
+        uvmap = find_normal_uvmap(material_of(src_geometry, material_index))
+        settings.append((material_index, uvmap))
+        if uvmap:
+            arrays.append(corners.select_loops(material_index))
+            arrays.extend(corners.loop_tangents(uvmap))
+    armature = src_geometry.find_armature()
+    if armature:
+        influences = mesh_influences(src_geometry, armature, corners, cfg)
+        arrays.extend([influences.count, influences.bone_index, influences.bone_weight])
+    for name, moved, deltas in shape_key_morphs(src_geometry, corners, cfg):
+        settings.append(name)
+        arrays.extend([moved, deltas])
+    digest.update(repr(settings).encode('utf-8'))
+    for array in arrays:
+        digest.update(numpy.ascontiguousarray(array))
+    return digest.hexdigest()
+
+
+def foreach_array(collection, attr, step, dtype=numpy.float32):
+    """read attr of every item of a bpy collection in one call (shape (n, step))"""
+    dst = numpy.empty(len(collection) * step, dtype=dtype)
+    collection.foreach_get(attr, dst)
+    return dst.reshape((len(collection), step))
+
+
+def partition(keys):
+    """return a dict {key: indices of the items with this key}, indices keep their order"""
+    order = numpy.argsort(keys, kind='mergesort')
+    used, starts = numpy.unique(keys[order], return_index=True)
+    return dict(zip(used.tolist(), numpy.split(order, starts[1:])))
+
+
+class MeshCorners:
+    """
+    index arrays to gather per corner (face vertex) data of the tessfaces,
+    corners are ordered like the faces, then like the vertices of each face.
+    Faces, corners and loops are partitioned by material once, and source arrays
+    are read once, so every material of the mesh reuses them.
+    """
+
+    def __init__(self, src_mesh):
+        self.src_mesh = src_mesh
+        faces = src_mesh.tessfaces
+        self.faces_count = len(faces)
+        self.face_vertices = foreach_array(faces, "vertices_raw", 4, numpy.int32)
+        # material_index is a short: a buffer of another type makes foreach_get read item by item
+        self.face_material = foreach_array(faces, "material_index", 1, numpy.int16)[:, 0].astype(numpy.int32)
+        # blender never store a quad with a 4th vertex at index 0 (it's the mark of triangle)
+        self.face_size = numpy.where(self.face_vertices[:, 3] != 0, 4, 3)
+        self.face = numpy.repeat(numpy.arange(self.faces_count), self.face_size)
+        face_start = numpy.cumsum(self.face_size) - self.face_size
+        self.slot = numpy.arange(len(self.face)) - numpy.repeat(face_start, self.face_size)
+        self.vertex = self.face_vertices[self.face, self.slot]
+        self._faces_by_material = partition(self.face_material)
+        self._corners_by_material = partition(self.face_material[self.face])
+        self._loops_by_material = None
+        self._arrays = {}
+
+    def materials(self):
+        """return the material indices used by faces, in order of first use"""
+        used, first = numpy.unique(self.face_material, return_index=True)
+        return used[numpy.argsort(first)].tolist()
+
+    def select_faces(self, material_index):
+        """return the indices of the faces with material_index"""
+        return self._faces_by_material.get(material_index, numpy.empty(0, dtype=numpy.int64))
+
+    def select(self, material_index):
+        """return the indices of the corners of the faces with material_index"""
+        return self._corners_by_material.get(material_index, numpy.empty(0, dtype=numpy.int64))
+
+    def select_loops(self, material_index):
+        """return the indices of the loops of the polygons with material_index"""
+        if self._loops_by_material is None:
+            polygons = self.src_mesh.polygons
+            loop_start = foreach_array(polygons, "loop_start", 1, numpy.int32)[:, 0]
+            loop_total = foreach_array(polygons, "loop_total", 1, numpy.int32)[:, 0]
+            material = foreach_array(polygons, "material_index", 1, numpy.int16)[:, 0].astype(numpy.int32)
+            offset = numpy.cumsum(loop_total) - loop_total
+            loop = numpy.arange(numpy.sum(loop_total)) - numpy.repeat(offset - loop_start, loop_total)
+            self._loops_by_material = dict((k, loop[v]) for k, v in partition(numpy.repeat(material, loop_total)).items())
+        return self._loops_by_material.get(material_index, numpy.empty(0, dtype=numpy.int64))
+
+    def gather(self, face_data, selected):
+        """gather per corner values from face_data (shape (faces_count, 4, step))"""
+        return face_data[self.face[selected], self.slot[selected]]
+
+    def cached(self, key, read):
+        """return the array stored under key, read() it on first call"""
+        if key not in self._arrays:
+            self._arrays[key] = read()
+        return self._arrays[key]
+
+    def vertex_array(self, attr):
+        """return attr (co, normal) of every vertex (shape (vertices_count, 3))"""
+        return self.cached(attr, lambda: foreach_array(self.src_mesh.vertices, attr, 3))
+
+    def face_colors(self):
+        """return the colors of the active vertex colors layer (shape (faces_count, 4, 4), alpha is 1.0)"""
+        def read():
+            face_colors = self.src_mesh.tessface_vertex_colors.active.data
+            colors = numpy.ones((self.faces_count, 4, 4), dtype=numpy.float32)
+            for i, attr in enumerate(("color1", "color2", "color3", "color4")):
+                colors[:, i, :3] = foreach_array(face_colors, attr, 3)
+            return colors
+        return self.cached("color", read)
+
+    def face_uvs(self, uvI):
+        """return the uvs of the uv layer uvI (shape (faces_count, 4, 2))"""
+        texcoordFace = self.src_mesh.tessface_uv_textures[uvI].data
+        return self.cached("uv%d" % uvI, lambda: foreach_array(texcoordFace, "uv_raw", 8).reshape((self.faces_count, 4, 2)))
+
+    def loop_tangents(self, uvmap):
+        """return (normals, tangents, bitangent_signs) of every loop, calc_tangents is done once per uvmap"""
+        def read():
+            loops = self.src_mesh.loops
+            #print(">>>>> calc_tangents on %r" % (uvmap))
+            self.src_mesh.calc_tangents(uvmap=uvmap)
+            return (foreach_array(loops, "normal", 3), foreach_array(loops, "tangent", 3), foreach_array(loops, "bitangent_sign", 1)[:, 0])
+        return self.cached("tangents_" + uvmap, read)
+
+
+def extract_mesh_arrays(src_mesh, corners, material_index, src_mat, cfg):
+    """return the MeshArrays of the faces with material_index, one vertex per corner"""
+    selected = corners.select(material_index)
+    vertex_arrays = []
+    vertex_arrays.append((xbuf.datas_pb2.VertexArray.position, corner_positions(src_mesh, corners, selected)))
+    vertex_arrays.append((xbuf.datas_pb2.VertexArray.tbn_to_model_quat, corner_tbns(src_mesh, corners, material_index, src_mat, cfg)))
+    vertex_arrays.extend(corner_colors(src_mesh, corners, selected))
+    vertex_arrays.extend(corner_texcoords(src_mesh, corners, selected))
+    return mesh_utils.MeshArrays(corners.vertex[selected], vertex_arrays, corner_triangles(corners, material_index))
+
+
+def corner_positions(src_mesh, corners, selected):
+    co = corners.vertex_array("co")
+    return cnv_toVec3ZupToYup_array(co[corners.vertex[selected]])
+
+
+def corner_tbns(src_mesh, corners, material_index, src_mat, cfg):
+    selected = corners.select(material_index)
+    uvmap = find_normal_uvmap(src_mat)
+    if uvmap:
+        loops = corners.select_loops(material_index)
+        if len(loops) == len(selected):
+            (normals, tangents, bitangent_signs) = corners.loop_tangents(uvmap)
+            return mesh_utils.cnv_toQuatZupToYup_array(mesh_utils.tbn_from_loop_array(normals[loops], tangents[loops], bitangent_signs[loops]))
+        # tessfaces of ngons don't match the loops of the polygons
+        cfg.warning("tbn from normal (ignore uv_layer %r) for %r (ngons are not supported)" % (uvmap, src_mat.name))
+    normals = corners.vertex_array("normal")
+    return mesh_utils.cnv_toQuatZupToYup_array(mesh_utils.tbn_from_normal_array(normals[corners.vertex[selected]]))
 
 # compute the invert quaternion that rotate (0, 0, 1) to the normal
 # see http://lolengine.net/blog/2013/09/18/beautiful-maths-quaternion-from-vectors
@@ -598,7 +1234,8 @@ def tbn_from_loop(vertex):
     q.invert()
     return q
 
-def find_tbn_fct(src_mesh, material_index, src_mat):
+def find_normal_uvmap(src_mat):
+    """return the uv_layer used by the normal map of src_mat (or None)"""
     uvmap = None
     if src_mat:
         for textureSlot in src_mat.texture_slots:
@@ -607,89 +1244,32 @@ def find_tbn_fct(src_mesh, material_index, src_mat):
             if not uvmap and textureSlot and textureSlot.use and textureSlot.use_map_normal and textureSlot.texture_coords == 'UV' and textureSlot.uv_layer:
                 #print(">>> found uv_layer")
                 uvmap = textureSlot.uv_layer
-    #else:
-    #    print(">>>> no src_mat")
-    if not uvmap:
-        #print(">>>>> tbn_from_normal")
-        fvertices = lambda face: [vertex for vertex in [src_mesh.vertices[i] for i in face.vertices]]
-        return tbn_from_normal, src_mesh.tessfaces, fvertices
-    else:
-        #print(">>>>> calc_tangents on %r" % (uvmap))
-        src_mesh.calc_tangents(uvmap=uvmap)
-        fvertices = lambda face : [vertex for vertex in [src_mesh.loops[i] for i in face.loop_indices]]
-        return tbn_from_loop, src_mesh.polygons, fvertices
-        #return tbn_from_normal
-
-def export_index(src_mesh, dst_mesh, material_index):
-    faces = src_mesh.tessfaces
-    dst = dst_mesh.indexArrays.add()
-    dst.ints.step = 3
-    ints = []
-    idx = 0
-    for face in faces:
-        if material_index != face.material_index:
-            continue
-        ints.append(idx)
-        idx += 1
-        ints.append(idx)
-        idx += 1
-        ints.append(idx)
-        idx += 1
-        if len(face.vertices) == 4:
-            ints.append(idx - 3)
-            ints.append(idx - 1)
-            ints.append(idx)
-            idx += 1
-    dst.ints.values.extend(ints)
-
-
-def export_colors(src_mesh, dst_mesh, material_index):
+    return uvmap
+
+def corner_triangles(corners, material_index):
+    """return the triangles (shape (m, 3)) of the faces with material_index, as indices of their selected corners"""
+    face_size = corners.face_size[corners.select_faces(material_index)]
+    face_start = numpy.cumsum(face_size) - face_size
+    # a quad (0, 1, 2, 3) is split into triangles (0, 1, 2) and (0, 2, 3)
+    ints = face_start[:, numpy.newaxis] + numpy.array([0, 1, 2, 0, 2, 3])
+    ints = ints[numpy.arange(6) < ((face_size - 2) * 3)[:, numpy.newaxis]]
+    return ints.reshape((-1, 3))
+
+
+def corner_colors(src_mesh, corners, selected):
+    """return [(attrib, values)] of the active vertex colors layer (empty if none)"""
     colorCount = len(src_mesh.tessface_vertex_colors)
     if colorCount < 1:
-        return
-    faces = src_mesh.tessfaces
-    face_colors = src_mesh.tessface_vertex_colors.active.data
-    dst = dst_mesh.vertexArrays.add()
-    dst.attrib = xbuf.datas_pb2.VertexArray.color
-    dst.floats.step = 4
-    floats = []
-    for face in faces:
-        if material_index != face.material_index:
-            continue
-        fc = face_colors[face.index]
-        floats.extend(fc.color1)
-        floats.append(1.0)
-        floats.extend(fc.color2)
-        floats.append(1.0)
-        floats.extend(fc.color3)
-        floats.append(1.0)
-        if len(face.vertices) == 4:
-            floats.extend(fc.color4)
-            floats.append(1.0)
-    dst.floats.values.extend(floats)
-
-
-def export_texcoords(src_mesh, dst_mesh, material_index):
-    texcoordCount = len(src_mesh.tessface_uv_textures)
-    if texcoordCount < 1:
-        return
-    faces = src_mesh.tessfaces
+        return []
+    return [(xbuf.datas_pb2.VertexArray.color, corners.gather(corners.face_colors(), selected))]
+
+
+def corner_texcoords(src_mesh, corners, selected):
+    """return [(attrib, values)] for the (max 9) uv layers"""
+    vertex_arrays = []
     for uvI in range(min(9, len(src_mesh.tessface_uv_textures))):
-        texcoordFace = src_mesh.tessface_uv_textures[uvI].data
-        dst = dst_mesh.vertexArrays.add()
-        dst.attrib = xbuf.datas_pb2.VertexArray.texcoord + uvI
-        dst.floats.step = 2
-        floats = []
-        for face in faces:
-            if material_index != face.material_index:
-                continue
-            ftc = texcoordFace[face.index]
-            floats.extend(ftc.uv1)
-            floats.extend(ftc.uv2)
-            floats.extend(ftc.uv3)
-            if len(face.vertices) == 4:
-                floats.extend(ftc.uv4)
-        dst.floats.values.extend(floats)
+        vertex_arrays.append((xbuf.datas_pb2.VertexArray.texcoord + uvI, corners.gather(corners.face_uvs(uvI), selected)))
+    return vertex_arrays
 
 
 def export_material(src_mat, dst_mat, cfg):
@@ -739,7 +1319,6 @@ def export_material(src_mat, dst_mat, cfg):
             cfg.warning("unsupported texture %r" % (textureSlot))
 
 def export_tex(src, dst, cfg):
-    import os
     # ispacked = src.texture.image.filepath.startswith('//')
     ispacked = not not src.texture.image.packed_file
     dst.id = cfg.id_of(src.texture)
@@ -755,26 +1334,17 @@ def export_tex(src, dst, cfg):
     #print("img_abspath %r" % (img_abspath))
     #print("d_rpath %r => d_abspath %r " % (d_rpath, d_abspath))
     if cfg.need_update(src.texture):
-        os.makedirs(os.path.dirname(d_abspath), exist_ok=True)
+        # written later (by cfg.assets), the manifest of the assets folder skips the write of unchanged files,
+        # a failed write (eg source file not found) is retried by the next export (see AssetsWriter.retry_failed)
         if ispacked:
-            with open(d_abspath, 'wb') as f:
-                f.write(src.texture.image.packed_file.data)
+            cfg.assets.write_bytes(src.texture.image.packed_file.data, d_rpath)
         else:
             #print("no packed texture %r // %r" % (src.texture, img_abspath))
-            import shutil
-            if os.path.isfile(img_abspath):
-                # no resolution of symlink, could cause issue ?
-                if img_abspath != d_abspath:
-                    try:
-                        shutil.copyfile(img_abspath, d_abspath)
-                    except shutil.SameFileError:
-                        dst.rpath = d_rpath.replace('\\', '/')
-            else:
-                cfg.warning("source file not found : %s" % (img_abspath))
+            # nothing is done if img_abspath and d_abspath are the same file
+            cfg.assets.copy_file(img_abspath, d_rpath)
     #else:
     #    print("no update of %r .. %r" % (dst.id, d_rpath))
     dst.rpath = d_rpath.replace('\\', '/')
-    # TODO use md5 (hashlib.md5().update(...)) to name or to check change ??
     # TODO If the texture has a scale and/or offset, then export a coordinate transform.
     # uscale = textureSlot.scale[0]
     # vscale = textureSlot.scale[1]
@@ -823,7 +1393,7 @@ def export_light(src, dst, cfg):
         dst.radial_distance.linear.end = 1.0
 
 
-def export_all_skeletons(scene, data, cfg):
+def export_all_skeletons(scene, data, cfg, users):
     for obj in scene.objects:
         if obj.type == 'ARMATURE':
             src_skeleton = obj.data
@@ -832,7 +1402,9 @@ def export_all_skeletons(scene, data, cfg):
                 dst_skeleton = data.skeletons.add()
                 export_skeleton(src_skeleton, dst_skeleton, cfg)
                 export_customproperties(src_skeleton, dst_skeleton, data, cfg)
-                add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj), xbuf.datas_pb2.Skeleton.__name__, cfg.id_of(src_skeleton), cfg)
+                # several object can share the same skeleton
+                for obj2 in users[src_skeleton]:
+                    add_relation_raw(data.relations, xbuf.datas_pb2.TObject.__name__, cfg.id_of(obj2), xbuf.datas_pb2.Skeleton.__name__, cfg.id_of(src_skeleton), cfg)
 
 
 def export_skeleton(src, dst, cfg):
@@ -867,76 +1439,86 @@ def export_skeleton(src, dst, cfg):
             rel.ref2 = dst_bone.id
 
 
-def export_skin(src_mesh, src_geometry, dst_mesh, cfg, material_index):
+def shape_key_morphs(src_geometry, corners, cfg):
+    """
+    return the (cached) morphs [(name, moved, deltas)] of the shape keys of src_geometry,
+    moved are the (sorted) indices of the vertices moved by the key and deltas their moves (y up)
+    relative to the relative_key of the key (like blender: mesh = basis + sum of weight * (key - relative_key)),
+    so the deltas of a key relative to another key than the basis are not its moves from the basis.
+    """
+    def read():
+        shape_keys = src_geometry.data.shape_keys
+        if shape_keys is None or not shape_keys.use_relative:
+            return []
+        if len(src_geometry.data.vertices) != len(corners.src_mesh.vertices):
+            cfg.warning("shape keys of %r are not exported: modifiers change the vertices" % (src_geometry.data.name))
+            return []
+        cos = {}
+        for key_block in shape_keys.key_blocks:
+            cos[key_block.name] = foreach_array(key_block.data, "co", 3)
+        morphs = []
+        for key_block in shape_keys.key_blocks:
+            if key_block == shape_keys.reference_key:
+                continue
+            delta = cos[key_block.name] - cos[key_block.relative_key.name]
+            moved = numpy.flatnonzero(numpy.any(numpy.abs(delta) > 1e-6, axis=1))
+            morphs.append((key_block.name, moved, cnv_toVec3ZupToYup_array(delta[moved])))
+        return morphs
+    return corners.cached("morphs", read)
+
+
+def skin_arrays(src_geometry, mesh_name, cfg, corners, vertex):
+    """return (boneCount, boneIndex, boneWeight) of the vertices (None if src_geometry has no armature)"""
     armature = src_geometry.find_armature()
     if not armature:
-        return
-
-    vertices = src_mesh.vertices
-    boneCount = []
-    boneIndex = []
-    boneWeight = []
-    groupToBoneIndex = make_group_to_bone_index(armature, src_geometry, cfg)
-    faces = src_mesh.tessfaces
+        return None
+
+    influences = mesh_influences(src_geometry, armature, corners, cfg)
+    max_count = cfg.skin_max_influences
+    if max_count > 0:
+        (bone_index, bone_weight, error) = corners.cached("influences_%d" % max_count, lambda: influences.limit(max_count))
+        boneCount = numpy.full(len(vertex), max_count, dtype=numpy.int64)
+        boneIndex = bone_index[vertex]
+        boneWeight = bone_weight[vertex]
+        cfg.info("skin of %r limited to %d influences per vertex, max weight error: %f" % (mesh_name, max_count, numpy.max(error[vertex]) if len(vertex) > 0 else 0.0))
+    else:
+        (boneCount, boneIndex, boneWeight) = influences.gather(vertex)
+    return (boneCount, boneIndex, boneWeight)
 
-    for face in faces:
-        if material_index != face.material_index:
-            continue
-        find_influence(vertices, face.vertices[0], groupToBoneIndex, boneCount, boneIndex, boneWeight)
-        find_influence(vertices, face.vertices[1], groupToBoneIndex, boneCount, boneIndex, boneWeight)
-        find_influence(vertices, face.vertices[2], groupToBoneIndex, boneCount, boneIndex, boneWeight)
-        if len(face.vertices) == 4:
-            find_influence(vertices, face.vertices[3], groupToBoneIndex, boneCount, boneIndex, boneWeight)
 
-    dst_skin = dst_mesh.skin
-    dst_skin.boneCount.extend(boneCount)
-    dst_skin.boneIndex.extend(boneIndex)
-    dst_skin.boneWeight.extend(boneWeight)
+def mesh_influences(src_geometry, armature, corners, cfg):
+    """return the (cached) VertexInfluences of the evaluated mesh of corners"""
+    return corners.cached("influences", lambda: find_influences(corners.src_mesh.vertices, make_group_to_bone_index(armature, src_geometry, cfg)))
 
 
 def make_group_to_bone_index(armature, src_geometry, cfg):
     groupToBoneIndex = []
     bones = armature.data.bones
     # Look up table for bone indices
-    bones_table = [b.name for b in bones]
+    bones_table = dict((b.name, i) for i, b in enumerate(bones))
 
     for group in src_geometry.vertex_groups:
         groupName = group.name
-        try:
-            index = bones_table.index(group.name)
-        except ValueError:
-            index = -1  # bind to nothing if not found
-        # for i in range(len(boneArray)):
-        #     if (boneArray[i].name == groupName):
-        #         index = i
-        #         break
+        index = bones_table.get(groupName, -1)  # bind to nothing if not found
         groupToBoneIndex.append(index)
         if index < 0:
             cfg.warning("groupVertex can't be bind to bone %s -> %s" % (groupName, index))
     return groupToBoneIndex
 
 
-def find_influence(vertices, index, groupToBoneIndex, boneCount, boneIndex, boneWeight):
-    totalWeight = 0.0
-    indexArray = []
-    weightArray = []
-    groups = sorted(vertices[index].groups, key=lambda x: x.weight, reverse=True)
-    for el in groups:
-        index = groupToBoneIndex[el.group]
-        weight = el.weight
-        if (index >= 0) and (weight > 0):
-            totalWeight += weight
-            indexArray.append(index)
-            weightArray.append(weight)
-    if totalWeight > 0:
-        normalizer = 1.0 / totalWeight
-        boneCount.append(len(weightArray))
-        for i in range(0, len(weightArray)):
-            boneIndex.append(indexArray[i])
-            boneWeight.append(weightArray[i] * normalizer)
-    else:
-        # print("vertex without influence")
-        boneCount.append(0)
+def find_influences(vertices, groupToBoneIndex):
+    """return the mesh_utils.VertexInfluences of every vertex"""
+    vertex = []
+    group = []
+    weight = []
+    for v in vertices:
+        for el in v.groups:
+            vertex.append(v.index)
+            group.append(el.group)
+            weight.append(el.weight)
+    return mesh_utils.VertexInfluences.from_groups(
+        len(vertices), numpy.array(vertex, dtype=numpy.int64), numpy.array(group, dtype=numpy.int64),
+        numpy.array(weight, dtype=numpy.float64), numpy.array(groupToBoneIndex, dtype=numpy.int64))
 
 
 def export_all_actions(scene, dst_data, cfg):
@@ -1486,11 +2068,12 @@ class xbufExporter(bpy.types.Operator, ExportHelper):
         # self.frameTime = 1.0 / (scene.render.fps_base * scene.render.fps)
 
         data = xbuf.datas_pb2.Data()
-        cfg = ExportCfg(is_preview=False, assets_path=assets_path)
-        export(scene, data, cfg)
+        cfg = ExportCfg(is_preview=False, assets_path=assets_path, skin_max_influences=scene.xbuf.skin_max_influences if scene.xbuf.skin_fixed_stride else 0, lod_count=scene.xbuf.lod_count, lod_ratio=scene.xbuf.lod_ratio, encode_workers=scene.xbuf.encode_workers, max_vertices=scene.xbuf.max_vertices, vertex_cache_size=scene.xbuf.vertex_cache_size, triangle_strips=scene.xbuf.triangle_strips, texture_workers=scene.xbuf.texture_workers, texture_strategy=scene.xbuf.texture_strategy)
+        encoded = export(scene, data, cfg)
+        cfg.close()
 
         file = open(self.filepath, "wb")
-        file.write(data.SerializeToString())
+        file.write(mesh_encoding.serialize_with(data, encoded))
         file.close()
 
         # if (self.restoreFrame):